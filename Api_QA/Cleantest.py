@@ -4,7 +4,11 @@ import pandas as pd
 import streamlit as st
 from datetime import datetime
 import io, re
+import time
+import unicodedata
 from utils_ingest import consolidate_attachments
+from utils_uploads import spool_uploads, as_buffer
+from utils_jobs import submit_ingest, get_job, cancel_job, pop_job
 
 
 # 1) SIEMPRE la primera llamada Streamlit
@@ -12,17 +16,18 @@ st.set_page_config(page_title="Generador QA", layout="wide", initial_sidebar_sta
 
 # 2) Importar utilidades propias SOLO una vez
 from auth_ui import SecureShell
-from utils_ui import titulo_seccion, spinner_accion
+from utils_ui import titulo_seccion, spinner_accion, pdf_page_count, render_pdf_page, text_page
 from utils_csv import (
     limpiar_markdown_csv, normalizar_preconditions, corregir_csv_con_comas,
-    normalizar_steps, limpiar_csv_con_formato, leer_csv_seguro
+    normalizar_steps, limpiar_csv_con_formato, leer_csv_seguro, ParserCsvIncremental
 )
 from utils_testrail import (
     obtener_proyectos, obtener_suites, obtener_secciones, enviar_a_testrail
 )
 from utils_gemini import (
     enviar_a_gemini, extraer_texto_de_respuesta_gemini,
-    prompt_generar_escenarios_profesionales, limitar_texto_para_gemini
+    prompt_generar_escenarios_profesionales, limitar_texto_para_gemini, gemini_cache_enabled,
+    generar_escenarios_en_paralelo, gemini_fanout_default, enviar_a_gemini_stream, respuesta_desde_texto
 )
 
 # 3) Login + tamaños independientes
@@ -117,44 +122,6 @@ def render_df_paginado(df, key_prefix: str, filas_por_pagina: int = 20, titulo:
 
 
 
-def _render_pdf_pages(file_bytes, dpi=140):
-    """Devuelve una lista de BytesIO (PNG) por página PDF."""
-    try:
-        import fitz  # PyMuPDF
-    except ImportError:
-        st.error("Falta 'pymupdf'. Instala con: pip install pymupdf")
-        return []
-    pages = []
-    with fitz.open(stream=bytes(file_bytes), filetype="pdf") as doc:
-        for page in doc:
-            pix = page.get_pixmap(dpi=dpi, alpha=False)
-            pages.append(io.BytesIO(pix.tobytes("png")))
-    return pages
-
-def _paginate_text(text, max_chars=3000):
-    """Corta el texto en 'páginas' sin perder párrafos."""
-    if not text:
-        return [""]
-    text = re.sub(r'\r\n?', '\n', text).strip()
-    paras = [p.strip() for p in re.split(r'\n{2,}', text) if p.strip()]
-    pages, buf = [], ""
-    for p in paras:
-        chunk = (("\n\n" if buf else "") + p)
-        if len(buf) + len(chunk) <= max_chars:
-            buf += chunk
-        else:
-            if buf:
-                pages.append(buf)
-            if len(chunk) > max_chars:
-                for i in range(0, len(chunk), max_chars):
-                    pages.append(chunk[i:i+max_chars])
-                buf = ""
-            else:
-                buf = chunk
-    if buf:
-        pages.append(buf)
-    return pages or [""]
-
 # Reemplaza COMPLETA esta función por la de abajo
 def preview_document_paginado_inline(
     file_label: str,
@@ -182,8 +149,8 @@ def preview_document_paginado_inline(
             if not file_bytes:
                 st.info("No se recibieron bytes del PDF.")
                 return
-            pages = _render_pdf_pages(file_bytes)
-            total = len(pages)
+            # Solo se renderiza la página visible (la siguiente se precarga en segundo plano)
+            total = pdf_page_count(file_bytes)
             if total == 0:
                 st.warning("No se pudo renderizar el PDF.")
                 return
@@ -213,16 +180,15 @@ def preview_document_paginado_inline(
 
             st.caption(f"Página {st.session_state[state_key]} de {total}")
             # 👇 Cambio clave: usar use_container_width (NO use_column_width)
-            st.image(pages[st.session_state[state_key]-1], use_container_width=True)
+            st.image(render_pdf_page(file_bytes, st.session_state[state_key]-1), use_container_width=True)
 
         else:
             if not text_extraido and file_bytes:
                 try:
-                    text_extraido = file_bytes.decode("utf-8", errors="ignore")
+                    text_extraido = str(as_buffer(file_bytes), "utf-8", errors="ignore")
                 except Exception:
                     text_extraido = ""
-            pages = _paginate_text(text_extraido or "", max_chars=3000)
-            total = len(pages)
+            _, total = text_page(text_extraido, 1, max_chars=3000)
             if state_key not in st.session_state:
                 st.session_state[state_key] = 1
 
@@ -249,7 +215,7 @@ def preview_document_paginado_inline(
 
             st.caption(f"Página {st.session_state[state_key]} de {total}")
             with st.container(border=True):
-                st.markdown(pages[st.session_state[state_key]-1])
+                st.markdown(text_page(text_extraido, st.session_state[state_key], max_chars=3000)[0])
 
 
 
@@ -262,6 +228,20 @@ from datetime import datetime
 import pandas as pd
 import streamlit as st
 
+def _recoger_ingesta(job):
+    """Copia el resultado de un trabajo de ingesta terminado al estado de la sesión."""
+    pop_job(job.id)
+    st.session_state.pop("ingest_job_id", None)
+    if job.status == "done":
+        st.session_state["attachments_text"] = job.text or ""
+        st.session_state["attachments_meta"] = job.metas or []
+        st.session_state["ingest_aviso"] = ("success", f"Procesado: {len(job.metas)} archivo(s).")
+    elif job.status == "cancelled":
+        st.session_state["ingest_aviso"] = ("info", "Procesamiento de adjuntos cancelado.")
+    else:
+        st.session_state["ingest_aviso"] = ("error", f"❌ Error procesando adjuntos: {job.error}")
+
+
 # ---------- RESET PRE-RUN (se ejecuta ANTES de crear widgets) ----------
 # Si el botón "Limpiar" se presionó en el run anterior, aquí se vacía todo
 if st.session_state.get("tab1_do_reset", False):
@@ -279,6 +259,13 @@ if st.session_state.get("tab1_do_reset", False):
         if k.startswith("t1:") or k.startswith("pview:") or (":page" in k):
             st.session_state.pop(k, None)
 
+    # Cancelar la ingesta en curso, si la hay
+    cancel_job(st.session_state.pop("ingest_job_id", None))
+
+    # Liberar blobs de adjuntos (memoria / mmap)
+    for blob in st.session_state.pop("upload_blobs", {}).values():
+        blob.close()
+
     # 🔁 Forzar reset REAL del uploader cambiando la key (nonce)
     st.session_state["tab1_uploader_nonce"] = st.session_state.get("tab1_uploader_nonce", 0) + 1
 
@@ -333,6 +320,9 @@ with tab1:
         accept_multiple_files=True,
         key=f"tab1_uploader_{st.session_state['tab1_uploader_nonce']}"
     )
+    # Cada archivo se lee una sola vez (a memoria o a disco según tamaño) y se
+    # reutiliza en extracción y preview durante los reruns
+    upload_blobs = spool_uploads(uploads, st.session_state.setdefault("upload_blobs", {}))
 
     colA, colB = st.columns([1,1])
     with colA:
@@ -344,21 +334,46 @@ with tab1:
     with colB:
         if st.button("Procesar adjuntos", key="btn_procesar_adjuntos"):
             if uploads:
-                try:
-                    from utils_ingest import consolidate_attachments
-                except Exception:
-                    consolidate_attachments = None
-                if consolidate_attachments is None:
-                    st.error("❌ Falta utils_ingest.consolidate_attachments en el entorno.")
-                else:
-                    files = [(f.name, f.read()) for f in uploads]
-                    txt, metas = consolidate_attachments(files, max_chars=60_000)
-                    st.session_state["attachments_text"] = txt or ""
-                    st.session_state["attachments_meta"] = metas or []
-                    st.success(f"Procesado: {len(st.session_state['attachments_meta'])} archivo(s).")
+                # En segundo plano: la página sigue respondiendo y el trabajo
+                # sobrevive a los reruns (el id queda en session_state).
+                # Archivo por archivo en el hilo del trabajo: así hay progreso por
+                # página y cancelación a mitad de documento; el OCR de cada PDF
+                # igual se reparte en el pool de procesos.
+                cancel_job(st.session_state.get("ingest_job_id"))
+                files = [(b.name, b) for b in upload_blobs]
+                st.session_state["ingest_job_id"] = submit_ingest(
+                    files, max_chars=60_000, query=st.session_state.get("texto_funcional")
+                )
             else:
                 st.info("No seleccionaste archivos.")
 
+    # ---- Progreso de la ingesta en segundo plano ----
+    def _panel_ingesta():
+        job = get_job(st.session_state.get("ingest_job_id"))
+        if job is None:
+            st.session_state.pop("ingest_job_id", None)
+            return
+        if job.is_active():
+            st.progress(job.progress(), text=f"⏳ {job.describe()}")
+            if st.button("Cancelar", key="btn_cancelar_ingesta"):
+                job.cancel()
+            return
+        _recoger_ingesta(job)
+        st.rerun()
+
+    if st.session_state.get("ingest_job_id"):
+        _fragmento = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+        if _fragmento is not None:
+            _fragmento(run_every=1.0)(_panel_ingesta)()
+        else:
+            _panel_ingesta()
+            time.sleep(1.0)
+            st.rerun()
+
+    _aviso = st.session_state.pop("ingest_aviso", None)
+    if _aviso:
+        getattr(st, _aviso[0])(_aviso[1])
+
     # ---- Metadatos de adjuntos (si existen) ----
     if st.session_state["attachments_meta"]:
         with st.expander("Fuentes procesadas", expanded=False):
@@ -366,18 +381,32 @@ with tab1:
                 st.caption(
                     f"• {m['filename']} ({m['ext']}, {m['size_bytes']} bytes) — "
                     f"{m['sha1_8']} — {m['chars']} chars"
+                    + (" — desde caché" if m.get("cache_hit") else "")
+                    + (f" — boilerplate −{m['boilerplate_chars']} chars" if m.get("boilerplate_chars") else "")
+                    + (f" — duplicados −{m['dedup_chars']} chars ({m['dedup_chunks']} trozos)" if m.get("dedup_chars") else "")
+                    + (f" — relevancia {m['chunks_selected']}/{m['chunks_total']} trozos" if "chunks_total" in m else "")
                 )
+                tiempos = m.get("timings_ms") or {}
+                if tiempos:
+                    etapas = ", ".join(f"{k} {v:.0f}" for k, v in tiempos.items() if k != "total")
+                    paginas = (
+                        f" — {m['pages']} págs, OCR {m.get('ocr_pages', 0)} (omitidas {m.get('ocr_pages_skipped', 0)})"
+                        if "pages" in m else ""
+                    )
+                    pico = f" — pico {m['peak_rss_mb']:.0f} MB" if m.get("peak_rss_mb") else ""
+                    imagen = f" — imagen {m['image_size']} → OCR {m['ocr_size']}" if m.get("ocr_size") else ""
+                    idioma = f" — OCR {m['ocr_lang']} ({m.get('ocr_lang_source')})" if m.get("ocr_lang") else ""
+                    st.caption(f"   ⏱ {tiempos.get('total', 0):.0f} ms ({etapas} ms){paginas}{imagen}{idioma}{pico}")
 
     # ---- Preview paginado (colapsable) ----
     st.markdown("### Preview paginado del documento")
     if uploads:
-        for i, f in enumerate(uploads, start=1):
-            bytes_f = f.getvalue() if hasattr(f, "getvalue") else f.read()
+        for i, blob in enumerate(upload_blobs, start=1):
             preview_document_paginado_inline(
-                file_label=f"Archivo {i}: {f.name}",
-                file_name=f.name,
-                file_bytes=bytes_f,
-                tipo=("pdf" if f.name.lower().endswith(".pdf") else "texto"),
+                file_label=f"Archivo {i}: {blob.name}",
+                file_name=blob.name,
+                file_bytes=blob,
+                tipo=("pdf" if blob.name.lower().endswith(".pdf") else "texto"),
                 key_ns="t1",
                 collapsible=True,
                 expanded=False
@@ -467,6 +496,72 @@ with tab1:
 
         return df_out.reset_index(drop=True)
 
+    def _csv_a_df_generado(texto_csv_raw):
+        # Limpieza y normalización CSV → DF
+        csv_limpio = limpiar_markdown_csv(texto_csv_raw)
+        csv_valido = limpiar_csv_con_formato(csv_limpio, columnas_esperadas=6)
+        csv_corregido = corregir_csv_con_comas(csv_valido, columnas_objetivo=6)
+
+        df_intento = pd.read_csv(io.StringIO(csv_corregido))
+        df_intento = df_intento.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+        df_intento = _normalizar_df_generado(df_intento)
+
+        if "Steps" in df_intento.columns:
+            df_intento["Steps"] = df_intento["Steps"].apply(normalizar_steps).str.replace(r'\\n', '\n', regex=True)
+        if "Preconditions" in df_intento.columns:
+            df_intento["Preconditions"] = df_intento["Preconditions"].apply(normalizar_preconditions)
+        df_intento["Estado"] = "Pendiente"
+        return df_intento
+
+    def _clave_titulo(valor):
+        # Sin acentos, mayúsculas ni puntuación: "Validación de monto." == "validacion de monto"
+        txt = unicodedata.normalize("NFKD", str(valor)).encode("ascii", "ignore").decode("ascii").lower()
+        return re.sub(r"[^a-z0-9]+", " ", txt).strip()
+
+    def _agregar_casos_nuevos(df, df_nuevo):
+        """Agrega a df los casos de df_nuevo cuyo título (normalizado) aún no existe."""
+        if "Title" in df_nuevo.columns:
+            claves = df_nuevo["Title"].map(_clave_titulo)
+            existentes = set(df["Title"].map(_clave_titulo)) if "Title" in df.columns else set()
+            df_nuevo = df_nuevo[~claves.isin(existentes) & ~claves.duplicated()]
+        if df.empty:
+            return df_nuevo.reset_index(drop=True)
+        return pd.concat([df, df_nuevo], ignore_index=True)
+
+    def _generar_csv_en_streaming(prompt_dict, usar_cache, df_base):
+        """
+        Genera con streamGenerateContent mostrando cada caso en cuanto su fila
+        CSV llega completa. Aborta si la respuesta no parece CSV.
+        Devuelve el texto completo (mismo formato que extraer_texto_de_respuesta_gemini).
+        """
+        parser = ParserCsvIncremental(columnas_esperadas=6)
+        columnas = ["Title", "Preconditions", "Steps", "Expected Result", "Type", "Priority"]
+        aviso, vista = st.empty(), st.empty()
+        partes, filas = [], []
+
+        def mostrar(nuevas):
+            if nuevas:
+                filas.extend(nuevas)
+                aviso.caption(f"📡 Recibiendo casos... {len(df_base) + len(filas)}")
+                vista.dataframe(pd.DataFrame(filas, columns=columnas)[["Title", "Type", "Priority"]],
+                                use_container_width=True, hide_index=True)
+
+        stream = enviar_a_gemini_stream(prompt_dict, usar_cache=usar_cache)
+        try:
+            for trozo in stream:
+                partes.append(trozo)
+                nuevas = parser.alimentar(trozo)
+                if parser.no_es_csv():
+                    raise ValueError("La respuesta de Gemini no es CSV; generación abortada.")
+                mostrar(nuevas)
+            # Última fila sin salto de línea final
+            mostrar(parser.cerrar())
+        finally:
+            stream.close()  # corta la conexión si se abortó
+            aviso.empty()
+            vista.empty()
+        return extraer_texto_de_respuesta_gemini(respuesta_desde_texto("".join(partes))).strip()
+
     def _estimar_rango_casos(texto_base: str):
         txt = (texto_base or "").strip()
         chars = len(txt)
@@ -496,17 +591,36 @@ with tab1:
         return minimo_aceptable, objetivo
 
     # ---- Generar escenarios ----
+    # Con la caché de respuestas habilitada, un prompt idéntico no vuelve a llamar a Gemini
+    sin_cache_gen = gemini_cache_enabled() and st.checkbox(
+        "🔄 Generación nueva (ignorar respuestas en caché)", key="gemini_sin_cache_tab1"
+    )
+    # Streaming: los casos aparecen a medida que Gemini los escribe
+    stream_gen = st.checkbox("📡 Mostrar casos a medida que llegan", value=True, key="gemini_stream_tab1")
+    # Fan-out: una llamada por categoría de cobertura, todas a la vez (más cuota, menos espera)
+    fanout_gen = st.checkbox(
+        "⚡ Generar por categoría en paralelo", value=gemini_fanout_default(), key="gemini_fanout_tab1",
+        help="Flujo feliz, negativos, límites e integración/seguridad en llamadas simultáneas."
+    )
     if st.button("Generar escenarios de prueba", key="btn_generar_tab1"):
         # 1) Si se usarán adjuntos y hay archivos subidos pero NO procesados aún, procesarlos aquí automáticamente
         usar_adj = st.session_state.get("use_attachments", True)
+        job = get_job(st.session_state.get("ingest_job_id"))
+        if usar_adj and job is not None:
+            # Ya hay un procesamiento en segundo plano: se espera en vez de repetirlo
+            with st.spinner("⏳ Esperando el procesamiento de adjuntos en curso..."):
+                job.wait()
+            _recoger_ingesta(job)
         if usar_adj and uploads and not st.session_state.get("attachments_text"):
             try:
                 from utils_ingest import consolidate_attachments
             except Exception:
                 consolidate_attachments = None
             if consolidate_attachments:
-                files = [(f.name, f.read()) for f in uploads]
-                txt, metas = consolidate_attachments(files, max_chars=60_000)
+                files = [(b.name, b) for b in upload_blobs]
+                txt, metas = consolidate_attachments(
+                    files, max_chars=60_000, parallel=True, query=st.session_state.get("texto_funcional")
+                )
                 st.session_state["attachments_text"] = txt or ""
                 st.session_state["attachments_meta"] = metas or []
 
@@ -525,7 +639,9 @@ with tab1:
 
                 with st.spinner("🧠 Preparando contexto para generación..."):
                     # Evita una llamada LLM adicional para ahorrar cuota.
-                    descripcion_refinada = limitar_texto_para_gemini(texto_entrada, max_chars=5000)
+                    descripcion_refinada = limitar_texto_para_gemini(
+                        texto_entrada, max_chars=5000, query=st.session_state["texto_funcional"]
+                    )
                 st.session_state["descripcion_refinada"] = descripcion_refinada
 
                 with st.spinner("📄 Generando escenarios CSV profesionales..."):
@@ -533,50 +649,56 @@ with tab1:
                     max_intentos_generacion = 3 if objetivo_casos >= 24 else 2
                     texto_csv_raw = ""
                     df = pd.DataFrame()
+                    intento_inicial = 1
 
-                    for intento_gen in range(1, max_intentos_generacion + 1):
+                    if fanout_gen:
+                        errores = []
+                        crudos_invalidos = []  # salida de las categorías que no se pudieron parsear
+                        for categoria, texto_cat, error in generar_escenarios_en_paralelo(
+                            descripcion_refinada,
+                            contexto_original=texto_entrada,
+                            target_cases=objetivo_casos,
+                            min_cases=min_casos_aceptables,
+                            consulta=st.session_state["texto_funcional"],
+                            usar_cache=not sin_cache_gen
+                        ):
+                            if error is not None:
+                                errores.append(f"{categoria['nombre']}: {error}")
+                                continue
+                            try:
+                                df = _agregar_casos_nuevos(df, _csv_a_df_generado(texto_cat))
+                            except Exception as e:
+                                errores.append(f"{categoria['nombre']}: CSV inválido ({e})")
+                                crudos_invalidos.append(f"--- {categoria['nombre']} ---\n{texto_cat}")
+                        texto_csv_raw = "\n\n".join(crudos_invalidos)
+                        if errores and df.empty:
+                            raise ValueError("; ".join(errores))
+                        if errores:
+                            st.warning("⚠️ Categorías sin resultado: " + "; ".join(errores))
+                        # El fan-out es el primer intento; solo se completa en serie si no llegó al mínimo
+                        intento_inicial = 2 if len(df) < min_casos_aceptables else max_intentos_generacion + 1
+
+                    for intento_gen in range(intento_inicial, max_intentos_generacion + 1):
                         titulos_previos = []
                         if not df.empty and "Title" in df.columns:
                             titulos_previos = df["Title"].astype(str).tolist()
 
-                        respuesta_csv = enviar_a_gemini(
-                            prompt_generar_escenarios_profesionales(
-                                descripcion_refinada,
-                                contexto_original=texto_entrada,
-                                target_cases=objetivo_casos,
-                                min_cases=min_casos_aceptables,
-                                titulos_excluir=titulos_previos
-                            )
+                        prompt_gen = prompt_generar_escenarios_profesionales(
+                            descripcion_refinada,
+                            contexto_original=texto_entrada,
+                            target_cases=objetivo_casos,
+                            min_cases=min_casos_aceptables,
+                            titulos_excluir=titulos_previos,
+                            consulta=st.session_state["texto_funcional"]
                         )
-                        texto_csv_raw = extraer_texto_de_respuesta_gemini(respuesta_csv).strip()
-
-                        # Limpieza y normalización CSV → DF
-                        csv_limpio = limpiar_markdown_csv(texto_csv_raw)
-                        csv_valido = limpiar_csv_con_formato(csv_limpio, columnas_esperadas=6)
-                        csv_corregido = corregir_csv_con_comas(csv_valido, columnas_objetivo=6)
-
-                        df_intento = pd.read_csv(io.StringIO(csv_corregido))
-                        df_intento = df_intento.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-                        df_intento = _normalizar_df_generado(df_intento)
-
-                        if "Steps" in df_intento.columns:
-                            df_intento["Steps"] = df_intento["Steps"].apply(normalizar_steps).str.replace(r'\\n', '\n', regex=True)
-                        if "Preconditions" in df_intento.columns:
-                            df_intento["Preconditions"] = df_intento["Preconditions"].apply(normalizar_preconditions)
-                        df_intento["Estado"] = "Pendiente"
+                        if stream_gen:
+                            texto_csv_raw = _generar_csv_en_streaming(prompt_gen, not sin_cache_gen, df)
+                        else:
+                            respuesta_csv = enviar_a_gemini(prompt_gen, usar_cache=not sin_cache_gen)
+                            texto_csv_raw = extraer_texto_de_respuesta_gemini(respuesta_csv).strip()
 
                         total_antes = len(df)
-                        if df.empty:
-                            df = df_intento.copy()
-                        else:
-                            if "Title" in df.columns and "Title" in df_intento.columns:
-                                existentes = set(df["Title"].astype(str).str.strip().str.lower())
-                                nuevos = df_intento[
-                                    ~df_intento["Title"].astype(str).str.strip().str.lower().isin(existentes)
-                                ].copy()
-                            else:
-                                nuevos = df_intento.copy()
-                            df = pd.concat([df, nuevos], ignore_index=True)
+                        df = _agregar_casos_nuevos(df, _csv_a_df_generado(texto_csv_raw))
                         crecieron = len(df) - total_antes
 
                         if len(df) >= objetivo_casos:
@@ -703,6 +825,9 @@ with tab3:
             # CSV de contexto para el LLM
             contexto_csv = df_revisar.to_csv(index=False)
 
+            sin_cache_sug = gemini_cache_enabled() and st.checkbox(
+                "🔄 Evaluación nueva (ignorar respuestas en caché)", key="gemini_sin_cache_sug"
+            )
             if st.button("🔍 Evaluar sugerencias", key="btn_eval_sug"):
                 try:
                     prompt = {
@@ -748,7 +873,7 @@ with tab3:
                     }
 
                     # Llama a Gemini y limpia salida
-                    respuesta = enviar_a_gemini(prompt)
+                    respuesta = enviar_a_gemini(prompt, usar_cache=not sin_cache_sug)
                     texto_raw = extraer_texto_de_respuesta_gemini(respuesta)
                     texto_csv = limpiar_markdown_csv(texto_raw)
 
@@ -0,0 +1,455 @@
+# bench_ingest.py
+# ---------------------------------------------
+# Benchmarks de utils_ingest
+#   python bench_ingest.py raster --pages 20
+#   python bench_ingest.py corpus --tiers small medium --out bench.json
+#   python bench_ingest.py compare base.json nuevo.json --tolerance 0.15
+#   python bench_ingest.py classifier
+# - raster: costo por página de preparar el raster que recibe el OCR
+#     png:     RGB -> PNG -> PIL.open/convert -> PNG temporal (camino anterior)
+#     directo: Pixmap gris -> PGM desde el buffer de muestras (camino actual)
+# - corpus: genera un corpus sintético determinista (PDF de texto, PDF escaneado,
+#     DOCX con tablas, XLSX ancho, CSV largo, fotos) por tamaño y mide
+#     extract_attachment por archivo y consolidate_attachments por tamaño
+#     (páginas/s, MB/s, RSS pico). Resultado en JSON para comparar corridas.
+# - compare: diferencias entre dos JSON de "corpus"; sale con código 1 si algún
+#     caso es más lento que la tolerancia (regresión)
+# - classifier: páginas escaneadas cortas (una línea, una firma, texto claro
+#     sobre fondo oscuro, página vacía con motas) contra el clasificador previo
+#     al OCR; sale con código 1 si descarta una página con contenido
+# ---------------------------------------------
+
+import os
+import io
+import sys
+import csv
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+import utils_ingest
+from utils_pages import RENDER_ZOOM, clear_page_cache
+
+try:
+    import docx  # python-docx
+except Exception:
+    docx = None
+
+try:
+    import openpyxl
+except Exception:
+    openpyxl = None
+
+# Parámetros del corpus por tamaño
+TIERS = {
+    "small": {"pdf_pages": 5, "scan_pages": 2, "docx_paras": 200, "docx_rows": 50,
+              "xlsx_rows": 200, "xlsx_cols": 20, "csv_rows": 1_000, "photo_px": (800, 600)},
+    "medium": {"pdf_pages": 30, "scan_pages": 8, "docx_paras": 2_000, "docx_rows": 500,
+               "xlsx_rows": 2_000, "xlsx_cols": 50, "csv_rows": 20_000, "photo_px": (1600, 1200)},
+    "large": {"pdf_pages": 120, "scan_pages": 24, "docx_paras": 10_000, "docx_rows": 2_000,
+              "xlsx_rows": 10_000, "xlsx_cols": 80, "csv_rows": 200_000, "photo_px": (3000, 2000)},
+}
+_PALABRAS = (
+    "regla tasa préstamo cuenta pago monto plazo cliente validar aprobar rechazar "
+    "saldo cuota interés fecha estado usuario perfil límite sucursal moneda"
+).split()
+
+
+def _frase(rnd: random.Random, n: int = 12) -> str:
+    return " ".join(rnd.choice(_PALABRAS) for _ in range(n)).capitalize() + "."
+
+
+def _pdf_de_prueba(pages: int) -> bytes:
+    doc = fitz.open()
+    linea = "Regla de negocio: validar monto, tasa y plazo del préstamo antes de aprobar."
+    for i in range(pages):
+        page = doc.new_page()
+        # insert_text no ajusta ni descarta líneas (insert_textbox omite el texto que no cabe)
+        page.insert_text((50, 60), f"Página {i + 1}\n" + "\n".join([linea] * 60), fontsize=9)
+    return doc.tobytes()
+
+
+def _raster_png(page, ruta_base: str) -> None:
+    pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
+    im = Image.open(io.BytesIO(pix.tobytes("png"))).convert("RGB")
+    im.save(ruta_base + ".png")
+
+
+def _raster_directo(page, ruta_base: str) -> None:
+    # Mismo raster que la extracción: render RGB canónico convertido a gris
+    pix = fitz.Pixmap(fitz.csGRAY, page.get_pixmap(matrix=fitz.Matrix(RENDER_ZOOM, RENDER_ZOOM), alpha=False))
+    utils_ingest._guardar_raster(pix, ruta_base)
+
+
+def _pdf_escaneado(pages: int) -> bytes:
+    """PDF solo imagen: cada página de texto rasterizada e insertada como imagen."""
+    origen = fitz.open(stream=_pdf_de_prueba(pages), filetype="pdf")
+    doc = fitz.open()
+    for page in origen:
+        pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5), colorspace=fitz.csGRAY, alpha=False)
+        nueva = doc.new_page(width=page.rect.width, height=page.rect.height)
+        nueva.insert_image(nueva.rect, pixmap=pix)
+    origen.close()
+    return doc.tobytes(deflate=True)
+
+
+def _escanear(dibujar, fondo: int = 255, size=(1240, 1754)) -> bytes:
+    """PDF de una página solo imagen: escaneo A4 a 150 dpi dibujado con dibujar(ImageDraw)."""
+    img = Image.new("L", size, fondo)
+    dibujar(ImageDraw.Draw(img))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=out.getvalue())
+    return doc.tobytes(deflate=True)
+
+
+def _lineas(n: int, fill: int = 0):
+    # ~11 pt a 150 dpi: letras de ~23 px de alto
+    def dibujar(d):
+        for i in range(n):
+            y = 200 + i * 46
+            for x in range(150, 1000, 40):
+                d.rectangle((x, y, x + 28, y + 23), fill=fill)
+    return dibujar
+
+
+def _motas(d):
+    for x, y in ((300, 400), (900, 1200), (640, 1600)):
+        d.point((x, y), fill=0)
+
+
+def _degrade(d):
+    for y in range(1754):
+        d.line((0, y, 1240, y), fill=40 + 180 * y // 1754)
+
+
+def _membrete(d):
+    d.ellipse((100, 100, 260, 260), fill=0)
+    for x in range(300, 900, 40):
+        d.rectangle((x, 160, x + 28, 183), fill=0)
+
+
+def _portada_con_titulo(d):
+    d.rectangle((0, 0, 1240, 1200), fill=90)
+    for x in range(200, 1000, 60):
+        d.rectangle((x, 1300, x + 44, 1345), fill=0)
+
+
+def _parrafo() -> bytes:
+    """Escaneo de un párrafo real a 10 pt e interlineado simple (líneas casi pegadas)."""
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_textbox(fitz.Rect(72, 72, 523, 770), " ".join(_PALABRAS) * 20, fontsize=10)
+    png = page.get_pixmap(dpi=150).tobytes("png")
+    scan = fitz.open()
+    page = scan.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=png)
+    return scan.tobytes(deflate=True)
+
+
+# (caso, pdf, debe_ir_a_ocr)
+CASOS_CLASIFICADOR = (
+    ("vacía", lambda: _escanear(lambda d: None), False),
+    ("motas", lambda: _escanear(_motas), False),
+    ("1 línea", lambda: _escanear(_lineas(1)), True),
+    ("3 líneas", lambda: _escanear(_lineas(3)), True),
+    ("6 líneas", lambda: _escanear(_lineas(6)), True),
+    ("texto gris", lambda: _escanear(_lineas(1, fill=170)), True),
+    ("firma", lambda: _escanear(lambda d: d.line((700, 1500, 1100, 1500), fill=0, width=3)), True),
+    ("fondo oscuro", lambda: _escanear(_lineas(3, fill=240), fondo=30), True),
+    ("párrafo", _parrafo, True),
+    ("membrete", lambda: _escanear(_membrete), True),
+    ("portada + título", lambda: _escanear(_portada_con_titulo), True),
+    ("logo", lambda: _escanear(lambda d: d.ellipse((100, 100, 300, 220), fill=0)), False),
+    ("sello", lambda: _escanear(lambda d: d.ellipse((800, 1300, 1100, 1600), outline=0, width=8)), False),
+    ("sello rectangular", lambda: _escanear(lambda d: d.rectangle((800, 1300, 1150, 1480), outline=0, width=8)), False),
+    ("portada degradé", lambda: _escanear(_degrade), False),
+    ("portada bloque", lambda: _escanear(lambda d: d.rectangle((0, 0, 1240, 1200), fill=90)), False),
+)
+
+
+def check_clasificador() -> list:
+    """[(caso, esperado, obtenido)] del clasificador previo al OCR."""
+    filas = []
+    for caso, crear, esperado in CASOS_CLASIFICADOR:
+        with fitz.open(stream=crear(), filetype="pdf") as doc:
+            filas.append((caso, esperado, utils_ingest._page_likely_has_text(doc[0])))
+    return filas
+
+
+def _docx_de_prueba(rnd: random.Random, parrafos: int, filas: int) -> bytes:
+    d = docx.Document()
+    for i in range(parrafos):
+        d.add_paragraph(_frase(rnd))
+        if filas and i % max(1, parrafos // 4) == 0:
+            tabla = d.add_table(rows=0, cols=4)
+            for _ in range(filas // 4):
+                celdas = tabla.add_row().cells
+                for c in celdas:
+                    c.text = _frase(rnd, 3)
+    out = io.BytesIO()
+    d.save(out)
+    return out.getvalue()
+
+
+def _xlsx_de_prueba(rnd: random.Random, filas: int, columnas: int) -> bytes:
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("datos")
+    ws.append([f"col_{c}" for c in range(columnas)])
+    for _ in range(filas):
+        ws.append([rnd.randint(0, 10_000) if c % 3 else rnd.choice(_PALABRAS) for c in range(columnas)])
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def _csv_de_prueba(rnd: random.Random, filas: int) -> bytes:
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["id", "cliente", "monto", "estado", "descripcion"])
+    for i in range(filas):
+        w.writerow([i, rnd.choice(_PALABRAS), rnd.randint(1, 99_999), rnd.choice(_PALABRAS), _frase(rnd, 6)])
+    return out.getvalue().encode("utf-8")
+
+
+def _foto_de_prueba(rnd: random.Random, size) -> bytes:
+    """Foto sintética: fondo con ruido y gradiente, y un bloque de texto encima."""
+    w, h = size
+    fondo = Image.frombytes("L", (w, h), bytes(rnd.getrandbits(8) // 4 + 160 for _ in range(w * h)))
+    img = Image.merge("RGB", (fondo, fondo.rotate(180), fondo))
+    dibujo = ImageDraw.Draw(img)
+    for i in range(min(30, h // 40)):
+        dibujo.text((w // 10, h // 10 + i * 30), _frase(rnd, 8), fill=(20, 20, 20))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def generar_corpus(tier: str, seed: int = 1234) -> list:
+    """Lista [(nombre, formato, bytes)] determinista para el tamaño indicado."""
+    cfg = TIERS[tier]
+    rnd = random.Random(f"{seed}:{tier}")
+    corpus = [
+        (f"{tier}_texto.pdf", "pdf_text", _pdf_de_prueba(cfg["pdf_pages"])),
+        (f"{tier}_escaneado.pdf", "pdf_scan", _pdf_escaneado(cfg["scan_pages"])),
+        (f"{tier}_largo.csv", "csv", _csv_de_prueba(rnd, cfg["csv_rows"])),
+        (f"{tier}_foto.jpg", "photo", _foto_de_prueba(rnd, cfg["photo_px"])),
+    ]
+    if docx is not None:
+        corpus.append((f"{tier}_tablas.docx", "docx", _docx_de_prueba(rnd, cfg["docx_paras"], cfg["docx_rows"])))
+    if openpyxl is not None:
+        corpus.append((f"{tier}_ancho.xlsx", "xlsx", _xlsx_de_prueba(rnd, cfg["xlsx_rows"], cfg["xlsx_cols"])))
+    return corpus
+
+
+def _rss_pico() -> float:
+    return utils_ingest._peak_rss_mb() or 0.0
+
+
+def _medir(fn, repeticiones: int, antes=None, despues=None):
+    """
+    Mejor tiempo (s) de varias repeticiones y el último resultado. antes() y
+    despues(resultado) corren en cada repetición, fuera de la medición.
+    """
+    mejor, res = None, None
+    for _ in range(repeticiones):
+        if antes is not None:
+            antes()
+        t0 = time.perf_counter()
+        res = fn()
+        dt = time.perf_counter() - t0
+        if despues is not None:
+            despues(res)
+        mejor = dt if mejor is None else min(mejor, dt)
+    return mejor, res
+
+
+def _caso(nombre: str, segundos: float, size: int, pages, rss: float) -> dict:
+    return {
+        "case": nombre,
+        "seconds": round(segundos, 4),
+        "mb": round(size / (1024 * 1024), 3),
+        "mb_per_s": round(size / (1024 * 1024) / segundos, 3) if segundos else None,
+        "pages": pages,
+        "pages_per_s": round(pages / segundos, 2) if pages and segundos else None,
+        "peak_rss_mb": rss,
+    }
+
+
+def _sin_cache(resultado) -> None:
+    """En frío ninguna extracción puede venir de la caché (tampoco en los workers del pool)."""
+    _, metas = resultado
+    for meta in metas if isinstance(metas, list) else [metas]:
+        if meta.get("cache_hit"):
+            raise RuntimeError(f"{meta['filename']}: leído de la caché de extracción en una corrida en frío")
+
+
+def bench_corpus(tiers, repeticiones: int = 1, seed: int = 1234, usar_cache: bool = False) -> dict:
+    """
+    Mide extract_attachment por archivo y consolidate_attachments (serial y
+    paralelo) por tamaño. Sin usar_cache, la caché de extracción se desactiva
+    (también en los workers del pool) y la caché de páginas (render y OCR en
+    memoria) se vacía antes de cada repetición, para medir siempre la
+    extracción real; si alguna extracción sale de la caché, falla.
+    """
+    cache_original = utils_ingest._EXTRACT_CACHE
+    env_original = os.environ.get("QA_EXTRACT_CACHE_MB")
+    en_frio = verificar = None
+    if not usar_cache:
+        utils_ingest._EXTRACT_CACHE = None
+        # Los workers (spawn) importan utils_ingest de nuevo y abren su propia
+        # caché según el entorno: se desactiva ahí y se recrea el pool
+        os.environ["QA_EXTRACT_CACHE_MB"] = "0"
+        utils_ingest._reset_pool()
+        en_frio, verificar = clear_page_cache, _sin_cache
+    casos = []
+    try:
+        # Arranque del pool fuera de la medición (spawn de los workers)
+        if utils_ingest.INGEST_MAX_WORKERS > 1:
+            utils_ingest._get_pool().submit(utils_ingest._ext, "calentar.txt").result()
+        for tier in tiers:
+            corpus = generar_corpus(tier, seed)
+            for nombre, formato, b in corpus:
+                dt, (_, meta) = _medir(
+                    lambda: utils_ingest.extract_attachment(nombre, b), repeticiones, en_frio, verificar
+                )
+                caso = _caso(f"extract/{tier}/{formato}", dt, len(b), meta.get("pages"),
+                             max(_rss_pico(), meta.get("peak_rss_mb") or 0.0))
+                caso.update(chars=meta["chars"], ocr_pages=meta.get("ocr_pages"), timings_ms=meta.get("timings_ms"))
+                casos.append(caso)
+
+            files = [(nombre, b) for nombre, _, b in corpus]
+            size = sum(len(b) for _, b in files)
+            for modo, paralelo in (("serial", False), ("parallel", True)):
+                dt, (_, metas) = _medir(
+                    lambda: utils_ingest.consolidate_attachments(files, max_chars=10**9, parallel=paralelo),
+                    repeticiones,
+                    en_frio,  # cada modo parte sin el OCR que dejaron los extract anteriores
+                    verificar,
+                )
+                pages = sum(m.get("pages", 0) for m in metas)
+                rss = max([_rss_pico()] + [m.get("peak_rss_mb") or 0.0 for m in metas])
+                casos.append(_caso(f"consolidate/{tier}/{modo}", dt, size, pages, rss))
+    finally:
+        utils_ingest._EXTRACT_CACHE = cache_original
+        if en_frio is not None:
+            if env_original is None:
+                os.environ.pop("QA_EXTRACT_CACHE_MB", None)
+            else:
+                os.environ["QA_EXTRACT_CACHE_MB"] = env_original
+            utils_ingest._reset_pool()  # los próximos workers vuelven a usar la caché
+            clear_page_cache()  # no dejar en memoria las páginas del corpus sintético
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "env": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "pymupdf": getattr(fitz, "VersionBind", None),
+            "extractor_version": utils_ingest.EXTRACTOR_VERSION,
+            "ingest_workers": utils_ingest.INGEST_MAX_WORKERS,
+            "ocr": utils_ingest.ocr_diagnostics(),
+        },
+        "params": {"tiers": list(tiers), "repeat": repeticiones, "seed": seed, "cache": usar_cache},
+        "cases": casos,
+    }
+
+
+def comparar(base: dict, nuevo: dict, tolerancia: float = 0.15) -> list:
+    """[(caso, s_base, s_nuevo, cambio_relativo, es_regresion)] para los casos presentes en ambos."""
+    previos = {c["case"]: c for c in base.get("cases", [])}
+    filas = []
+    for c in nuevo.get("cases", []):
+        b = previos.get(c["case"])
+        if b is None or not b["seconds"]:
+            continue
+        cambio = c["seconds"] / b["seconds"] - 1
+        filas.append((c["case"], b["seconds"], c["seconds"], cambio, cambio > tolerancia))
+    return filas
+
+
+def bench_raster(pages: int, repeticiones: int = 3) -> dict:
+    b = _pdf_de_prueba(pages)
+    resultados = {}
+    with fitz.open(stream=b, filetype="pdf") as doc, tempfile.TemporaryDirectory(prefix="qa_bench_") as tmp:
+        for nombre, fn in (("png", _raster_png), ("directo", _raster_directo)):
+            mejor = None
+            for _ in range(repeticiones):
+                t0 = time.perf_counter()
+                for pno in range(doc.page_count):
+                    fn(doc[pno], os.path.join(tmp, f"{nombre}_{pno}"))
+                dt = time.perf_counter() - t0
+                mejor = dt if mejor is None else min(mejor, dt)
+            resultados[nombre] = mejor / doc.page_count * 1000
+    resultados["ahorro_ms_por_pagina"] = resultados["png"] - resultados["directo"]
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de utils_ingest")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_raster = sub.add_parser("raster", help="costo por página del raster para OCR")
+    p_raster.add_argument("--pages", type=int, default=20)
+    p_raster.add_argument("--repeat", type=int, default=3)
+    p_corpus = sub.add_parser("corpus", help="corpus sintético por formato y tamaño")
+    p_corpus.add_argument("--tiers", nargs="+", choices=list(TIERS), default=["small", "medium"])
+    p_corpus.add_argument("--repeat", type=int, default=1)
+    p_corpus.add_argument("--seed", type=int, default=1234)
+    p_corpus.add_argument("--cache", action="store_true", help="usar la caché de extracción")
+    p_corpus.add_argument("--out", default="bench_ingest.json")
+    p_cmp = sub.add_parser("compare", help="compara dos resultados de 'corpus'")
+    p_cmp.add_argument("base")
+    p_cmp.add_argument("nuevo")
+    p_cmp.add_argument("--tolerance", type=float, default=0.15)
+    sub.add_parser("classifier", help="páginas escaneadas cortas contra el clasificador previo al OCR")
+    args = parser.parse_args()
+
+    if args.cmd == "raster":
+        r = bench_raster(args.pages, args.repeat)
+        print(f"png:     {r['png']:.1f} ms/página")
+        print(f"directo: {r['directo']:.1f} ms/página")
+        print(f"ahorro:  {r['ahorro_ms_por_pagina']:.1f} ms/página")
+
+    elif args.cmd == "corpus":
+        r = bench_corpus(args.tiers, args.repeat, args.seed, args.cache)
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(r, fh, ensure_ascii=False, indent=2)
+        for c in r["cases"]:
+            pps = f"{c['pages_per_s']:.1f} pág/s" if c["pages_per_s"] else ""
+            print(f"{c['case']:<28} {c['seconds'] * 1000:9.1f} ms  {c['mb_per_s'] or 0:8.2f} MB/s  "
+                  f"{pps:>12}  RSS {c['peak_rss_mb']:.0f} MB")
+        print(f"-> {args.out}")
+
+    elif args.cmd == "compare":
+        with open(args.base, encoding="utf-8") as fh:
+            base = json.load(fh)
+        with open(args.nuevo, encoding="utf-8") as fh:
+            nuevo = json.load(fh)
+        filas = comparar(base, nuevo, args.tolerance)
+        for caso, s_base, s_nuevo, cambio, regresion in filas:
+            marca = "  REGRESIÓN" if regresion else ""
+            print(f"{caso:<28} {s_base * 1000:9.1f} -> {s_nuevo * 1000:9.1f} ms  {cambio:+7.1%}{marca}")
+        if any(f[4] for f in filas):
+            sys.exit(1)
+
+    elif args.cmd == "classifier":
+        filas = check_clasificador()
+        for caso, esperado, obtenido in filas:
+            marca = "" if esperado == obtenido else "  FALLA"
+            print(f"{caso:<18} esperado {'OCR' if esperado else 'saltar':<7} obtenido {'OCR' if obtenido else 'saltar'}{marca}")
+        if any(esperado != obtenido for _, esperado, obtenido in filas):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
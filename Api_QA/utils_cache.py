@@ -0,0 +1,137 @@
+# utils_cache.py
+# ---------------------------------------------
+# Caché persistente clave -> valor en disco local (SQLite)
+# - Valores JSON (texto extraído, respuestas, etc.)
+# - Límite de tamaño total con expulsión LRU (por último acceso)
+# - TTL opcional por caché
+# - Seguro entre hilos y procesos: una conexión por operación
+# ---------------------------------------------
+
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+CACHE_DIR = os.environ.get("QA_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "qa_cache")
+
+
+class DiskCache:
+    """
+    Caché LRU acotada por bytes sobre un archivo SQLite.
+    Si el disco no es utilizable, la caché queda deshabilitada y get() siempre
+    devuelve None (nunca rompe el flujo principal).
+    """
+
+    def __init__(self, name: str, max_bytes: int, ttl_seconds: Optional[float] = None, directory: str = CACHE_DIR):
+        self.path = os.path.join(directory, f"{name}.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.enabled = True
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._connect() as con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                    " created REAL NOT NULL, accessed REAL NOT NULL)"
+                )
+                con.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON entries(accessed)")
+        except Exception:
+            self.enabled = False
+
+    @contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=10)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            with con:  # commit / rollback
+                yield con
+        finally:
+            con.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self._connect() as con:
+                row = con.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                    con.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    con.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        except Exception:
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            return json.loads(row[0])
+        except Exception:
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        try:
+            blob = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            if len(blob) > self.max_bytes:
+                return
+            now = time.time()
+            with self._connect() as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now),
+                )
+                self._evict(con)
+        except Exception:
+            pass
+
+    def _evict(self, con: sqlite3.Connection) -> None:
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Expulsa por último acceso hasta volver bajo el límite
+        for key, size in con.execute("SELECT key, size FROM entries ORDER BY accessed ASC").fetchall():
+            con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self._connect() as con:
+                con.execute("DELETE FROM entries")
+        except Exception:
+            pass
+
+    def stats(self) -> Dict:
+        entries, size = 0, 0
+        if self.enabled:
+            try:
+                with self._connect() as con:
+                    entries, size = con.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            except Exception:
+                pass
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,398 @@
+# utils_context.py
+# ---------------------------------------------
+# Limpieza del contexto antes de enviarlo al modelo
+# - Boilerplate: encabezados, pies, avisos de confidencialidad y números de
+#   página que se repiten en cada página (y entre adjuntos)
+# - Casi duplicados: trozos de texto (párrafos) que se repiten casi idénticos
+#   entre adjuntos (versiones de la misma especificación), por MinHash
+# - Empaquetado por relevancia: en vez de cortar por posición, se eligen los
+#   trozos con mejor puntaje BM25 contra el texto funcional hasta llenar el
+#   presupuesto, y se devuelven en su orden original
+# ---------------------------------------------
+
+import os
+import re
+import math
+import zlib
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+STRIP_BOILERPLATE = os.environ.get("QA_STRIP_BOILERPLATE", "1") not in ("0", "false", "no")
+
+# Solo se miran las primeras/últimas líneas de cada página: el cuerpo nunca se toca
+BOILERPLATE_EDGE_LINES = 3
+BOILERPLATE_MAX_LINE = 200      # líneas más largas son párrafos, no encabezados
+BOILERPLATE_MAX_REPORT = 50     # tope de líneas informadas en los metadatos
+BOILERPLATE_MIN_REPEATS = 3     # apariciones en bordes de página para confirmar una línea
+
+_ESPACIOS = re.compile(r"\s+")
+_DIGITOS = re.compile(r"\d+")
+# Numeración de página: "Página 3 de 10", "pág. 3", "Page 3 of 10", "- 3 -", "3/10"
+_NUM_PAGINA = re.compile(r"\b(?:p[aá]g(?:ina)?|page|hoja)\.?\s*\d+(?:\s*(?:de|of|/)\s*\d+)?")
+_SOLO_NUMERO = re.compile(r"^\W*\d+(?:\s*(?:de|of|/)\s*\d+)?\W*$")
+
+
+def _numerar(m: "re.Match") -> str:
+    return _DIGITOS.sub("#", m.group(0))
+
+
+def normalizar_linea(linea: str) -> str:
+    """
+    Forma canónica para comparar: minúsculas y espacios colapsados. Solo los
+    números de la numeración de página pasan a '#'; el resto se conserva para
+    no confundir líneas que difieren en un número ("Artículo 5" / "Artículo 6").
+    """
+    norm = _ESPACIOS.sub(" ", linea).strip().lower()
+    if _SOLO_NUMERO.match(norm):
+        return _DIGITOS.sub("#", norm)
+    return _NUM_PAGINA.sub(_numerar, norm)
+
+
+class BoilerplateFilter:
+    """
+    Detector en línea de líneas repetidas en los bordes de página.
+    Recorre las páginas en orden: una línea de borde se confirma como
+    boilerplate al aparecer en el borde de min_repeats páginas, y desde esa
+    aparición se descarta (las anteriores se conservan). Al ser en línea, el
+    resultado de las primeras N páginas no depende de las siguientes
+    (compatible con leer por tramos con presupuesto).
+    """
+
+    def __init__(
+        self,
+        edge_lines: int = BOILERPLATE_EDGE_LINES,
+        known: Optional[Iterable[str]] = None,
+        min_repeats: int = BOILERPLATE_MIN_REPEATS,
+    ):
+        self.edge_lines = edge_lines
+        self.min_repeats = min_repeats
+        self.vistas: Dict[str, int] = {}
+        self.repetidas: Set[str] = set(known or ())
+        self.chars_saved = 0
+
+    def _descartar(self, norm: str) -> bool:
+        if norm in self.repetidas:
+            return True
+        self.vistas[norm] = self.vistas.get(norm, 0) + 1
+        if self.vistas[norm] >= self.min_repeats:
+            self.repetidas.add(norm)
+            return True
+        return False
+
+    def _bordes(self, lineas: List[str], tail: bool) -> Set[int]:
+        llenas = [i for i, l in enumerate(lineas) if l.strip()]
+        return set(llenas[: self.edge_lines] + (llenas[-self.edge_lines:] if tail else []))
+
+    def filter_page(self, texto: str, tail: bool = True) -> str:
+        """
+        Quita de la página las líneas de borde confirmadas (o que se confirman
+        con esta aparición). tail=False mira solo el inicio (texto que puede
+        venir cortado al final).
+        """
+        lineas = texto.split("\n")
+        bordes = self._bordes(lineas, tail)
+        quitar = set()
+        for i in sorted(bordes):
+            if len(lineas[i]) <= BOILERPLATE_MAX_LINE and self._descartar(normalizar_linea(lineas[i])):
+                quitar.add(i)
+        if not quitar:
+            return texto
+        self.chars_saved += sum(len(lineas[i]) + 1 for i in quitar)
+        return "\n".join(l for i, l in enumerate(lineas) if i not in quitar).strip()
+
+    def filter_known(self, texto: str, tail: bool = True) -> str:
+        """
+        Quita las líneas ya confirmadas como boilerplate, solo en posición de
+        encabezado/pie (primeras/últimas edge_lines líneas con texto; con
+        tail=False solo las primeras). Sin contar apariciones nuevas.
+        """
+        if not self.repetidas:
+            return texto
+        lineas = texto.split("\n")
+        quitar = {
+            i for i in self._bordes(lineas, tail)
+            if len(lineas[i]) <= BOILERPLATE_MAX_LINE and normalizar_linea(lineas[i]) in self.repetidas
+        }
+        if not quitar:
+            return texto
+        self.chars_saved += sum(len(lineas[i]) + 1 for i in quitar)
+        return "\n".join(l for i, l in enumerate(lineas) if i not in quitar).strip()
+
+    def snapshot(self):
+        return dict(self.vistas), set(self.repetidas), self.chars_saved
+
+    def restore(self, estado) -> None:
+        vistas, repetidas, chars_saved = estado
+        self.vistas, self.repetidas, self.chars_saved = dict(vistas), set(repetidas), chars_saved
+
+    def report(self) -> List[str]:
+        return sorted(self.repetidas)[:BOILERPLATE_MAX_REPORT]
+
+
+# ===== Casi duplicados (MinHash + LSH) =====
+DEDUP_CHUNKS = os.environ.get("QA_DEDUP_CHUNKS", "1") not in ("0", "false", "no")
+DEDUP_THRESHOLD = 0.8           # similitud de Jaccard estimada para considerar duplicado
+DEDUP_CHUNK_CHARS = 500         # tamaño objetivo de un trozo (caracteres sin espacios)
+DEDUP_MIN_CHARS = 80            # trozos más cortos no se reemplazan (la referencia no ahorra)
+_SHINGLE = 5                    # palabras por shingle
+_PERMUTACIONES = 64
+_BANDAS = 16                    # 16 bandas x 4 filas: P(candidato | J=0.8) > 0.999
+_PRIMO = (1 << 31) - 1
+_rng = np.random.default_rng(20240501)
+_MH_A = _rng.integers(1, _PRIMO, size=_PERMUTACIONES, dtype=np.int64)
+_MH_B = _rng.integers(0, _PRIMO, size=_PERMUTACIONES, dtype=np.int64)
+_PALABRA = re.compile(r"\w+")
+
+
+def _segmentos(texto: str):
+    """Líneas (con su salto) y, si son muy largas, tramos de ~DEDUP_CHUNK_CHARS cortados en un espacio."""
+    for linea in texto.split("\n"):
+        while len(linea) > 2 * DEDUP_CHUNK_CHARS:
+            corte = linea.rfind(" ", 0, DEDUP_CHUNK_CHARS)
+            corte = corte + 1 if corte > 0 else DEDUP_CHUNK_CHARS
+            yield linea[:corte]
+            linea = linea[corte:]
+        yield linea + "\n"
+
+
+def _trozos(texto: str) -> List[Tuple[int, int]]:
+    """
+    Spans (inicio, fin) de trozos de líneas contiguas. Un trozo cierra en una
+    línea que termina una oración una vez alcanzada la mitad del tamaño
+    objetivo (o al doble, sin más). El tamaño cuenta solo caracteres visibles,
+    así el mismo contenido se corta igual en un PDF (líneas partidas) que en
+    un DOCX (un párrafo por línea, con o sin líneas en blanco).
+    Las líneas más largas que el doble del objetivo se parten en espacios.
+    """
+    spans = []
+    inicio = pos = visibles = 0
+    for linea in _segmentos(texto):
+        pos += len(linea)
+        visibles += len(linea) - linea.count(" ") - linea.count("\n")
+        fin_oracion = linea.rstrip().endswith((".", "!", "?", ":", ";"))
+        if (fin_oracion and visibles >= DEDUP_CHUNK_CHARS // 2) or visibles >= 2 * DEDUP_CHUNK_CHARS:
+            spans.append((inicio, min(pos, len(texto))))
+            inicio, visibles = pos, 0
+    if inicio < len(texto):
+        spans.append((inicio, len(texto)))
+    return spans
+
+
+def _firma(palabras: List[str]) -> np.ndarray:
+    h = np.array(
+        [zlib.crc32(" ".join(palabras[i:i + _SHINGLE]).encode("utf-8")) for i in range(len(palabras) - _SHINGLE + 1)],
+        dtype=np.int64,
+    )
+    return ((_MH_A[:, None] * h[None, :] + _MH_B[:, None]) % _PRIMO).min(axis=1)
+
+
+class NearDuplicateFilter:
+    """
+    Índice de trozos ya incluidos en el contexto. filter() reemplaza cada
+    racha de trozos casi idénticos a uno anterior por una referencia
+    [SRC:sha1_8] a la fuente que conserva la copia.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.fuentes: List[str] = []                    # id de trozo -> sha1_8 de su fuente
+        self.firmas: Dict[int, np.ndarray] = {}
+        self.exactos: Dict[str, int] = {}
+        self.bandas: Dict[Tuple[int, bytes], List[int]] = {}
+        self.chars_saved = 0
+        self.chunks_dropped = 0
+
+    def _duplicado_de(self, trozo: str) -> Tuple[Optional[str], Optional[str], Optional[np.ndarray]]:
+        palabras = _PALABRA.findall(trozo.lower())
+        clave = " ".join(palabras)
+        if clave in self.exactos:
+            return self.fuentes[self.exactos[clave]], clave, None
+        if len(palabras) < _SHINGLE:
+            return None, clave, None
+        firma = _firma(palabras)
+        filas = _PERMUTACIONES // _BANDAS
+        candidatos = set()
+        for b in range(_BANDAS):
+            candidatos.update(self.bandas.get((b, firma[b * filas:(b + 1) * filas].tobytes()), ()))
+        for c in sorted(candidatos):
+            if np.mean(self.firmas[c] == firma) >= self.threshold:
+                return self.fuentes[c], clave, firma
+        return None, clave, firma
+
+    def _registrar(self, src: str, clave: str, firma: Optional[np.ndarray]) -> None:
+        i = len(self.fuentes)
+        self.fuentes.append(src)
+        self.exactos.setdefault(clave, i)
+        if firma is not None:
+            self.firmas[i] = firma
+            filas = _PERMUTACIONES // _BANDAS
+            for b in range(_BANDAS):
+                self.bandas.setdefault((b, firma[b * filas:(b + 1) * filas].tobytes()), []).append(i)
+
+    def filter(self, texto: str, src: str, truncated: bool = False) -> Tuple[str, Optional[int]]:
+        """
+        Devuelve (texto_filtrado, inicio_cola). Con truncated=True el último
+        trozo puede estar incompleto: se deja tal cual, sin registrar, e
+        inicio_cola indica dónde empieza en el texto filtrado (None si no aplica).
+        """
+        spans = _trozos(texto)
+        partes: List[str] = []
+        largo = 0
+        refs: List[str] = []
+        cola = None
+
+        def volcar_refs():
+            nonlocal largo
+            if refs:
+                marca = "".join(f"[SRC:{r}]\n" for r in refs)
+                partes.append(marca)
+                largo += len(marca)
+                self.chars_saved -= len(marca)
+                refs.clear()
+
+        for n, (a, b) in enumerate(spans):
+            trozo = texto[a:b]
+            if truncated and n == len(spans) - 1:
+                volcar_refs()
+                cola = largo
+                partes.append(trozo)
+                break
+            dup, clave, firma = self._duplicado_de(trozo)
+            if dup is not None and len(trozo.strip()) >= DEDUP_MIN_CHARS:
+                if dup not in refs:
+                    refs.append(dup)
+                self.chars_saved += len(trozo)
+                self.chunks_dropped += 1
+                continue
+            volcar_refs()
+            if dup is None:
+                self._registrar(src, clave, firma)
+            partes.append(trozo)
+            largo += len(trozo)
+        volcar_refs()
+        return "".join(partes).strip(), cola
+
+    def snapshot(self):
+        return len(self.fuentes), self.chars_saved, self.chunks_dropped
+
+    def restore(self, estado) -> None:
+        n, self.chars_saved, self.chunks_dropped = estado
+        del self.fuentes[n:]
+        self.firmas = {i: f for i, f in self.firmas.items() if i < n}
+        self.exactos = {k: i for k, i in self.exactos.items() if i < n}
+        self.bandas = {k: [i for i in ids if i < n] for k, ids in self.bandas.items()}
+
+
+# ===== Empaquetado por relevancia (BM25) =====
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+PACK_GAP = "[...]\n"           # marca de trozos omitidos entre los elegidos
+# Texto candidato que se extrae para elegir por relevancia: hasta
+# PACK_EXTRACT_FACTOR x max_chars. Más candidatos mejoran la selección, pero
+# cada página extra de un PDF escaneado cuesta un OCR.
+PACK_EXTRACT_FACTOR = int(os.environ.get("QA_PACK_EXTRACT_FACTOR", "4") or 4)
+_STOPWORDS = set("""
+    a al algo ante antes asi como con contra cual cuando de del desde donde
+    durante e el ella ellas ellos en entre era es esa ese eso esta este esto
+    estos estas fue ha han hasta hay la las le les lo los mas me mi muy no
+    nos o otra otro para pero por que quien se segun ser si sin sobre su sus
+    tambien te tiene toda todo todos tu un una uno unos unas y ya
+    the of and to in for on with is are be by this that it as or an at from
+""".split())
+
+
+def _raiz(palabra: str) -> str:
+    """Stemming mínimo para español: plural y vocal final (préstamos -> prestam)."""
+    if len(palabra) > 4 and palabra.endswith("s"):
+        palabra = palabra[:-1]
+    if len(palabra) > 4 and palabra[-1] in "aeo":
+        palabra = palabra[:-1]
+    return palabra
+
+
+def _terminos_texto(texto: str) -> List[str]:
+    plano = unicodedata.normalize("NFKD", texto.lower())
+    plano = "".join(c for c in plano if not unicodedata.combining(c))
+    return [_raiz(w) for w in _PALABRA.findall(plano) if len(w) > 2 and w not in _STOPWORDS and not w.isdigit()]
+
+
+def query_terms(query: Optional[str]) -> List[str]:
+    """Términos únicos de la consulta (texto funcional), normalizados como los trozos."""
+    return list(dict.fromkeys(_terminos_texto(query or "")))
+
+
+def _bm25(trozos: List[str], terminos: List[str]) -> List[float]:
+    tfs = [Counter(_terminos_texto(t)) for t in trozos]
+    n = len(tfs)
+    largo_medio = (sum(sum(tf.values()) for tf in tfs) / n) if n else 0.0
+    df = Counter(t for tf in tfs for t in set(tf) if t in terminos)
+    idf = {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in terminos}
+    puntajes = []
+    for tf in tfs:
+        dl = sum(tf.values())
+        norma = _BM25_K1 * (1 - _BM25_B + _BM25_B * dl / largo_medio) if largo_medio else _BM25_K1
+        puntajes.append(sum(idf[t] * tf[t] * (_BM25_K1 + 1) / (tf[t] + norma) for t in terminos if tf[t]))
+    return puntajes
+
+
+def pack_sources(fuentes: List[Tuple[str, str]], query: Optional[str], max_chars: int) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Empaqueta varias fuentes [(encabezado, texto)] en max_chars caracteres.
+    Los trozos se eligen por puntaje BM25 contra query (los de puntaje 0
+    completan después, por posición) y se emiten en el orden original, cada
+    fuente con su encabezado y PACK_GAP donde se omitió texto.
+    Devuelve (texto, [(trozos_elegidos, trozos_totales) por fuente]).
+    """
+    terminos = query_terms(query)
+    trozos: List[Tuple[int, int, str]] = []     # (fuente, posición, texto)
+    for i, (_, texto) in enumerate(fuentes):
+        trozos.extend((i, j, texto[a:b]) for j, (a, b) in enumerate(_trozos(texto)))
+    puntajes = _bm25([t for _, _, t in trozos], terminos) if terminos else [0.0] * len(trozos)
+
+    # Costo conservador: cada trozo puede abrir un hueco antes; cada fuente, su
+    # encabezado y un hueco final. Así el resultado nunca supera max_chars.
+    elegidos: Set[int] = set()
+    abiertas: Set[int] = set()
+    usado = 0
+    for k in sorted(range(len(trozos)), key=lambda k: (-puntajes[k], k)):
+        i, _, texto = trozos[k]
+        costo = len(texto) + len(PACK_GAP)
+        if i not in abiertas:
+            costo += len(f"\n\n{fuentes[i][0]}\n") + len(PACK_GAP)
+        if usado + costo > max_chars:
+            continue
+        usado += costo
+        elegidos.add(k)
+        abiertas.add(i)
+
+    bloques: List[str] = []
+    conteo = [[0, 0] for _ in fuentes]
+    for i, (encabezado, _) in enumerate(fuentes):
+        propios = [k for k, (f, _, _) in enumerate(trozos) if f == i]
+        conteo[i][1] = len(propios)
+        if i not in abiertas:
+            continue
+        cuerpo: List[str] = []
+        previo = -1
+        for k in propios:
+            if k not in elegidos:
+                continue
+            if trozos[k][1] != previo + 1:
+                cuerpo.append(PACK_GAP)
+            cuerpo.append(trozos[k][2] if trozos[k][2].endswith("\n") else trozos[k][2] + "\n")
+            previo = trozos[k][1]
+            conteo[i][0] += 1
+        if previo != len(propios) - 1:
+            cuerpo.append(PACK_GAP)
+        bloques.append(f"\n\n{encabezado}\n" + "".join(cuerpo).rstrip("\n"))
+    return "".join(bloques).strip(), [tuple(c) for c in conteo]
+
+
+def pack_by_relevance(texto: str, query: Optional[str], max_chars: int) -> str:
+    """Versión de una sola fuente de pack_sources; "" si la consulta no tiene términos útiles."""
+    if not query_terms(query):
+        return ""
+    return pack_sources([("", texto)], query, max_chars)[0]
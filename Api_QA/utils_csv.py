@@ -349,3 +349,88 @@ def corregir_csv_gemini(csv_raw):
                 writer.writerow(fixed_row)
 
     return output.getvalue()
+
+
+class ParserCsvIncremental:
+    """
+    Parser CSV por trozos para respuestas en streaming: alimentar() recibe el
+    texto a medida que llega y devuelve las filas ya completas (un salto de
+    línea fuera de comillas cierra la fila; las celdas pueden tener saltos
+    de línea entre comillas y "" escapado). Ignora cercas Markdown, líneas
+    vacías y el encabezado (queda en `encabezado`).
+    Cuenta filas válidas (columnas esperadas), filas CSV con otra cantidad de
+    columnas (no se muestran: las repara después corregir_csv_con_comas) y
+    líneas inválidas (csv no las puede leer o son prosa) para abortar antes
+    una respuesta que no es CSV.
+    """
+
+    # Prosa: encabezados/listas Markdown o frases que presentan algo ("Aquí tienes:")
+    _PROSA = re.compile(r"^\s*(#|\*|>|-\s)|:\s*$")
+
+    def __init__(self, columnas_esperadas: int = 6, max_lineas_invalidas: int = 3):
+        self.columnas_esperadas = columnas_esperadas
+        self.max_lineas_invalidas = max_lineas_invalidas
+        self.encabezado = None
+        self.filas_validas = 0
+        self.filas_a_reparar = 0
+        self.filas_invalidas = 0
+        self._buf = ""
+        self._pos = 0               # hasta dónde ya se escaneó _buf
+        self._en_comillas = False
+
+    def _procesar_linea(self, linea: str):
+        linea = linea.strip("\r")
+        if not linea.strip() or linea.lstrip().startswith("```"):
+            return None
+        try:
+            fila = next(csv.reader(io.StringIO(linea), skipinitialspace=True))
+        except (csv.Error, StopIteration):
+            self.filas_invalidas += 1
+            return None
+        fila = [campo.strip() for campo in fila]
+        if self.encabezado is None and self.filas_validas == 0 and fila and fila[0].lower() == "title":
+            self.encabezado = fila
+            return None
+        if len(fila) != self.columnas_esperadas:
+            if len(fila) < 2 or self._PROSA.search(linea):
+                self.filas_invalidas += 1
+            else:
+                self.filas_a_reparar += 1  # p. ej. comas sin comillas dentro de un campo
+            return None
+        self.filas_validas += 1
+        return fila
+
+    def alimentar(self, texto: str) -> list:
+        """Agrega texto recibido y devuelve las filas que quedaron completas."""
+        self._buf += texto
+        filas = []
+        inicio = 0
+        i = self._pos
+        while i < len(self._buf):
+            c = self._buf[i]
+            if c == '"':
+                self._en_comillas = not self._en_comillas
+            elif c == "\n" and not self._en_comillas:
+                fila = self._procesar_linea(self._buf[inicio:i])
+                if fila is not None:
+                    filas.append(fila)
+                inicio = i + 1
+            i += 1
+        self._buf = self._buf[inicio:]
+        self._pos = len(self._buf)
+        return filas
+
+    def cerrar(self) -> list:
+        """Fin de la respuesta: procesa la última fila (sin salto de línea final)."""
+        resto, self._buf, self._pos = self._buf, "", 0
+        fila = self._procesar_linea(resto)
+        return [fila] if fila is not None else []
+
+    def no_es_csv(self) -> bool:
+        """True si ya llegaron varias líneas inválidas y ninguna fue encabezado ni fila CSV."""
+        return (
+            self.encabezado is None
+            and self.filas_validas == 0
+            and self.filas_a_reparar == 0
+            and self.filas_invalidas >= self.max_lineas_invalidas
+        )
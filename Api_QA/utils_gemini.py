@@ -11,9 +11,18 @@ import argparse
 import streamlit as st
 import pandas as pd
 import time
+import gzip
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # utils_gemini.py
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Tuple
+
+from utils_cache import DiskCache
+from utils_context import pack_by_relevance
 
 SYSTEM_PROMPT_ES = """Eres un analista QA senior. A partir del contexto, genera escenarios de prueba sÃ³lidos:
 - Cubre flujo feliz, errores, bordes y no-funcionales (performance, seguridad, accesibilidad).
@@ -41,15 +50,104 @@ def generar_escenarios_desde_contexto(contexto_total: str, metas: List[Dict] = N
 
 
 
+# Categorías de cobertura para la generación en paralelo (fan-out): cada una
+# es un sub-prompt con su parte del objetivo de casos (peso relativo)
+CATEGORIAS_COBERTURA = [
+    {
+        "clave": "flujo_feliz",
+        "nombre": "Flujo feliz",
+        "peso": 3,
+        "foco": (
+            "- Flujo feliz end-to-end y sus variantes validas (perfiles, estados, combinaciones de parametros).\n"
+            "- Reglas de negocio y calculos con datos validos.\n"
+            "- Persistencia y trazabilidad/auditoria del resultado."
+        ),
+    },
+    {
+        "clave": "negativos",
+        "nombre": "Negativos y validaciones",
+        "peso": 3,
+        "foco": (
+            "- Validaciones de campos obligatorios, formatos y tipos de dato.\n"
+            "- Datos invalidos y reglas de negocio incumplidas.\n"
+            "- Mensajeria de error clara y sin efectos en datos."
+        ),
+    },
+    {
+        "clave": "limites",
+        "nombre": "Limites y frontera",
+        "peso": 2,
+        "foco": (
+            "- Valores frontera (minimo, maximo, justo dentro/fuera) de montos, tasas, plazos y cantidades.\n"
+            "- Redondeos y calculos en los extremos.\n"
+            "- Vacios, ceros, longitudes maximas."
+        ),
+    },
+    {
+        "clave": "integracion_seguridad",
+        "nombre": "Integracion y seguridad",
+        "peso": 2,
+        "foco": (
+            "- Integracion con servicios/dependencias: respuestas correctas, timeout, caidas, datos inconsistentes.\n"
+            "- Seguridad y permisos por rol (accesos permitidos y denegados).\n"
+            "- Usabilidad basica de los mensajes ante fallas."
+        ),
+    },
+]
+
+_OBJETIVO_COBERTURA_COMPLETO = """OBJETIVO DE COBERTURA (adaptar al contexto real):
+- Flujo feliz end-to-end.
+- Validaciones de campos y formatos.
+- Reglas de negocio y calculos.
+- Limites y valores frontera.
+- Integracion y fallas de servicios/dependencias.
+- Seguridad y permisos por rol.
+- Usabilidad/mensajeria de error/persistencia.
+Si alguna categoria no aplica al contexto, no fuerces casos artificiales."""
+
+
+def _objetivo_cobertura(categoria: Optional[Dict]) -> str:
+    if not categoria:
+        return _OBJETIVO_COBERTURA_COMPLETO
+    otras = ", ".join(c["nombre"] for c in CATEGORIAS_COBERTURA if c["clave"] != categoria["clave"])
+    return (
+        f"OBJETIVO DE COBERTURA - SOLO categoria \"{categoria['nombre']}\" (adaptar al contexto real):\n"
+        f"{categoria['foco']}\n"
+        f"Otras categorias ({otras}) se generan por separado: NO incluyas casos de ellas.\n"
+        "Si la categoria no aplica al contexto, devuelve solo el encabezado o pocos casos justificables."
+    )
+
+
+def repartir_casos(target_cases: int, min_cases: int, categorias: List[Dict] = None) -> List[Tuple[Dict, int, int]]:
+    """Reparte el objetivo (y el mínimo) de casos entre categorías según su peso: [(categoria, min, objetivo)]."""
+    categorias = categorias or CATEGORIAS_COBERTURA
+    total_peso = sum(c["peso"] for c in categorias) or 1
+    reparto = []
+    for c in categorias:
+        objetivo = max(2, -(-target_cases * c["peso"] // total_peso))
+        minimo = max(1, min(objetivo, min_cases * c["peso"] // total_peso))
+        reparto.append((c, minimo, objetivo))
+    return reparto
+
+
 def prompt_generar_escenarios_profesionales(
     descripcion_refinada,
     contexto_original="",
     target_cases=20,
     min_cases=8,
-    titulos_excluir=None
+    titulos_excluir=None,
+    consulta=None,
+    categoria=None
 ):
-    descripcion_refinada = limitar_texto_para_gemini(descripcion_refinada, max_chars=7000)
-    contexto_original = limitar_texto_para_gemini(contexto_original or "", max_chars=8000)
+    """
+    Payload de generación de casos en CSV. Con categoria (una de
+    CATEGORIAS_COBERTURA) el objetivo de cobertura se limita a esa categoría.
+    """
+    descripcion_refinada = limitar_texto_para_gemini(descripcion_refinada, max_chars=7000, query=consulta)
+    contexto_original = limitar_texto_para_gemini(
+        contexto_original or "", max_chars=8000, query=consulta or descripcion_refinada
+    )
+    objetivo_cobertura = _objetivo_cobertura(categoria)
 
     prompt_text = f"""
 Eres un QA Senior especialista en pruebas funcionales y de negocio para sistemas financieros.
@@ -73,15 +171,7 @@ REGLAS DE SALIDA OBLIGATORIAS:
 - En Title NO uses prefijos de enumeracion ni labels tecnicos: prohibido "SCENARIO", "Escenario", "Caso #", "TC-", numeros al inicio o codigos.
 - En Title usa estilo natural QA: frases cortas y especificas como "Validacion de ...", "Regla: ...", "Reestructuracion ...", "Integracion ...".
 
-OBJETIVO DE COBERTURA (adaptar al contexto real):
-- Flujo feliz end-to-end.
-- Validaciones de campos y formatos.
-- Reglas de negocio y calculos.
-- Limites y valores frontera.
-- Integracion y fallas de servicios/dependencias.
-- Seguridad y permisos por rol.
-- Usabilidad/mensajeria de error/persistencia.
-Si alguna categoria no aplica al contexto, no fuerces casos artificiales.
+{objetivo_cobertura}
 
 CRITERIO PROFESIONAL DE CALIDAD:
 - Evita casos duplicados o vagos.
@@ -317,10 +407,11 @@ def _parsear_error_http(response):
     mensaje = ""
     razon = ""
     metrica = ""
+    cuota_id = ""
     retry_seconds = None
 
     if response is None:
-        return status, mensaje, razon, metrica, detalle, retry_seconds
+        return status, mensaje, razon, metrica, detalle, retry_seconds, cuota_id
 
     try:
         payload = response.json()
@@ -340,7 +431,12 @@ def _parsear_error_http(response):
                         or str(metadata.get("metric", "")).strip()
                     )
                 violations = item.get("violations", [])
-                if isinstance(violations, list) and violations and not metrica:
+                if isinstance(violations, list) and not cuota_id:
+                    # quotaId dice el periodo ("...PerDay...", "...PerMinute..."), la métrica no
+                    cuota_id = ",".join(
+                        str(v.get("quotaId", "")).strip() for v in violations if isinstance(v, dict) and v.get("quotaId")
+                    )
+                if isinstance(violations, list) and violations and not metrica:
                     first = violations[0]
                     if isinstance(first, dict):
                         metrica = (
@@ -369,7 +465,7 @@ def _parsear_error_http(response):
     except Exception:
         detalle = ""
 
-    return status, mensaje, razon, metrica, detalle, retry_seconds
+    return status, mensaje, razon, metrica, detalle, retry_seconds, cuota_id
 
 
 def _es_cuota_agotada(mensaje_error: str) -> bool:
@@ -383,119 +479,615 @@ def _es_cuota_agotada(mensaje_error: str) -> bool:
     )
 
 
-def enviar_a_gemini(prompt_dict, max_intentos=4, espera_inicial=2):
+# ===== Cliente HTTP (sesión keep-alive compartida por proceso) =====
+# Opcional en .streamlit/secrets.toml:
+#   gemini_gzip = true        comprime cuerpos grandes (Content-Encoding: gzip)
+#   gemini_gzip_min_kb = 16   tamaño mínimo del cuerpo para comprimir
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+
+
+def _rechaza_gzip(response) -> bool:
+    """
+    True si la respuesta rechaza el Content-Encoding: 411/415, o un 400 cuyo
+    cuerpo habla de la codificación. Otros 400 (API_KEY_INVALID,
+    INVALID_ARGUMENT del prompt) no tienen que ver con gzip.
+    """
+    if response.status_code in (411, 415):
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        texto = response.text.lower()
+    except Exception:
+        return False
+    return any(p in texto for p in ("gzip", "content-encoding", "encoding", "compress"))
+
+
+class GeminiClient:
+    """
+    Sesión requests con pool de conexiones keep-alive: los reintentos, las
+    keys y los modelos de respaldo (y las sesiones de Streamlit) reutilizan
+    las conexiones TLS en vez de abrir una nueva por POST.
+    Seguro entre hilos para POSTs concurrentes (pool de hasta pool_maxsize).
+    """
+
+    def __init__(self, pool_maxsize: int = 8, gzip_min_bytes: Optional[int] = None):
+        self.gzip_min_bytes = gzip_min_bytes
+        self.session = requests.Session()
+        self.session.verify = certifi.where()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+
+    def encode(self, payload) -> tuple:
+        """(cuerpo, headers extra) del payload; se serializa una vez por llamada, no por intento."""
+        cuerpo = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if self.gzip_min_bytes is not None and len(cuerpo) >= self.gzip_min_bytes:
+            return gzip.compress(cuerpo, compresslevel=5), {"Content-Encoding": "gzip"}
+        return cuerpo, {}
+
+    def post(self, modelo: str, api_key: str, cuerpo: tuple, metodo: str = "generateContent",
+             timeout: float = 60, **kwargs) -> requests.Response:
+        datos, extra = cuerpo
+        headers = {"Content-Type": "application/json; charset=utf-8", "X-goog-api-key": api_key, **extra}
+        url = f"{GEMINI_BASE_URL}/{modelo}:{metodo}"
+        response = self.session.post(url, data=datos, headers=headers, timeout=timeout, **kwargs)
+        if extra and _rechaza_gzip(response):
+            # La API no aceptó el cuerpo comprimido: se desactiva gzip y se reenvía plano
+            self.gzip_min_bytes = None
+            response.close()
+            headers.pop("Content-Encoding", None)
+            response = self.session.post(url, data=gzip.decompress(datos), headers=headers, timeout=timeout, **kwargs)
+        return response
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_CLIENTE: Optional[GeminiClient] = None
+_CLIENTE_LOCK = threading.Lock()
+
+
+def _cliente_gemini() -> GeminiClient:
+    global _CLIENTE
+    with _CLIENTE_LOCK:
+        if _CLIENTE is None:
+            try:
+                usar_gzip = _secreto_bool(st.secrets.get("gemini_gzip", False))
+                min_kb = float(st.secrets.get("gemini_gzip_min_kb", 16))
+            except Exception:
+                usar_gzip, min_kb = False, 16
+            _CLIENTE = GeminiClient(gzip_min_bytes=int(min_kb * 1024) if usar_gzip else None)
+        return _CLIENTE
+
+
+# ===== Salud de keys/modelos (registro por proceso) =====
+# Recuerda entre llamadas (y sesiones) qué key/modelo agotó cuota y hasta
+# cuándo, cuáles keys son inválidas, la latencia reciente y la tasa de
+# errores. Cada llamada empieza por la opción más sana y salta las enfriadas.
+SALUD_ALFA = 0.3                    # peso de la última observación (EWMA)
+SALUD_VIDA_MEDIA_ERRORES = 600      # la tasa de errores se desvanece con el tiempo (s)
+SALUD_TASA_ENFERMA = 0.5            # desde aquí el par va al final de la lista
+ENFRIAMIENTO_CUOTA_MINUTO = 60      # cuota por minuto sin RetryInfo (s)
+ENFRIAMIENTO_CUOTA_DIA = 3600       # cuota diaria: se reintenta en una hora (s)
+MAX_ESPERA_ENFRIAMIENTO = 60        # si todo está enfriado, se espera como máximo esto
+
+
+def _id_key(api_key: str) -> str:
+    return hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def _es_cuota_diaria(metrica: str, cuota_id: str) -> bool:
+    return "day" in f"{metrica or ''} {cuota_id or ''}".lower()
+
+
+def _enfriamiento_cuota(metrica: str, cuota_id: str, retry_seconds: Optional[int]) -> float:
+    # La cuota diaria no vuelve en los segundos del RetryInfo: se espera al menos una hora
+    if _es_cuota_diaria(metrica, cuota_id):
+        return float(max(ENFRIAMIENTO_CUOTA_DIA, retry_seconds or 0))
+    if retry_seconds:
+        return float(retry_seconds)
+    return float(ENFRIAMIENTO_CUOTA_MINUTO)
+
+
+class GeminiHealthRegistry:
+    """Estado por par (key, modelo) y keys inválidas; seguro entre hilos."""
+
+    def __init__(self):
+        self._pares: Dict[Tuple[str, str], Dict] = {}
+        self._invalidas = set()
+        self._lock = threading.Lock()
+
+    def _par(self, modelo: str, api_key: str) -> Dict:
+        return self._pares.setdefault(
+            (api_key, modelo),
+            {"agotada_hasta": 0.0, "latencia_s": None, "tasa_error": 0.0, "t_error": 0.0, "ok": 0, "errores": 0},
+        )
+
+    def _tasa(self, estado: Dict, ahora: float) -> float:
+        return estado["tasa_error"] * 0.5 ** ((ahora - estado["t_error"]) / SALUD_VIDA_MEDIA_ERRORES)
+
+    def marcar_ok(self, modelo: str, api_key: str, latencia_s: Optional[float] = None) -> None:
+        ahora = time.time()
+        with self._lock:
+            e = self._par(modelo, api_key)
+            e["ok"] += 1
+            e["agotada_hasta"] = 0.0
+            e["tasa_error"], e["t_error"] = self._tasa(e, ahora) * (1 - SALUD_ALFA), ahora
+            if latencia_s is not None:
+                previa = e["latencia_s"]
+                e["latencia_s"] = latencia_s if previa is None else previa + SALUD_ALFA * (latencia_s - previa)
+
+    def marcar_error(self, modelo: str, api_key: str) -> None:
+        ahora = time.time()
+        with self._lock:
+            e = self._par(modelo, api_key)
+            e["errores"] += 1
+            e["tasa_error"], e["t_error"] = self._tasa(e, ahora) * (1 - SALUD_ALFA) + SALUD_ALFA, ahora
+
+    def marcar_cuota(self, modelo: str, api_key: str, segundos: float) -> None:
+        with self._lock:
+            e = self._par(modelo, api_key)
+            e["agotada_hasta"] = max(e["agotada_hasta"], time.time() + segundos)
+
+    def marcar_key_invalida(self, api_key: str) -> None:
+        with self._lock:
+            self._invalidas.add(api_key)
+
+    def key_invalida(self, api_key: str) -> bool:
+        with self._lock:
+            return api_key in self._invalidas
+
+    def orden(self, modelos: List[str], api_keys: List[str]):
+        """
+        (disponibles, enfriados). disponibles: [(modelo, idx_key, key)] de la
+        opción más sana a la menos (pares con muchos errores al final; luego
+        preferencia de modelo y menor latencia; un par aún sin medir cuenta
+        con la mediana de su modelo, no por delante de los sanos conocidos).
+        enfriados: [(hasta, modelo,
+        idx_key, key)] con cuota agotada, el que se libera antes primero.
+        Las keys inválidas no aparecen.
+        """
+        ahora = time.time()
+        disponibles, enfriados = [], []
+        with self._lock:
+            for i_modelo, modelo in enumerate(modelos):
+                medidas = sorted(
+                    e["latencia_s"] for (_, m), e in self._pares.items() if m == modelo and e["latencia_s"] is not None
+                )
+                mediana = medidas[len(medidas) // 2] if medidas else 0.0
+                for idx_key, api_key in enumerate(api_keys, start=1):
+                    if api_key in self._invalidas:
+                        continue
+                    e = self._pares.get((api_key, modelo))
+                    if e is not None and e["agotada_hasta"] > ahora:
+                        enfriados.append((e["agotada_hasta"], modelo, idx_key, api_key))
+                        continue
+                    enferma = e is not None and self._tasa(e, ahora) >= SALUD_TASA_ENFERMA
+                    latencia = e["latencia_s"] if e is not None and e["latencia_s"] is not None else mediana
+                    disponibles.append(((enferma, i_modelo, latencia, idx_key), (modelo, idx_key, api_key)))
+        disponibles.sort(key=lambda x: x[0])
+        enfriados.sort()
+        return [c for _, c in disponibles], enfriados
+
+    def snapshot(self) -> Dict:
+        """Estado para diagnóstico (las keys se identifican por hash, nunca en claro)."""
+        ahora = time.time()
+        with self._lock:
+            pares = [
+                {
+                    "key": _id_key(api_key),
+                    "model": modelo,
+                    "cooldown_s": max(0, round(e["agotada_hasta"] - ahora)),
+                    "latency_s": round(e["latencia_s"], 2) if e["latencia_s"] is not None else None,
+                    "error_rate": round(self._tasa(e, ahora), 3),
+                    "ok": e["ok"],
+                    "errors": e["errores"],
+                }
+                for (api_key, modelo), e in self._pares.items()
+            ]
+            return {"pairs": pares, "invalid_keys": sorted(_id_key(k) for k in self._invalidas)}
+
+
+_SALUD = GeminiHealthRegistry()
+
+
+def gemini_health() -> Dict:
+    return _SALUD.snapshot()
+
+
+def _candidatos_saludables(modelos: List[str], api_keys: List[str]) -> List[Tuple[str, int, str]]:
+    """
+    Pares (modelo, idx_key, key) a probar, del más sano al menos. Si todos
+    están enfriados por cuota, espera al primero que se libere cuando falta
+    poco (MAX_ESPERA_ENFRIAMIENTO); si no, falla sin gastar llamadas.
+    """
+    disponibles, enfriados = _SALUD.orden(modelos, api_keys)
+    if disponibles:
+        return disponibles
+    if not enfriados:
+        raise ValueError("Todas las API keys de Gemini están marcadas como invalidas/expiradas.")
+    hasta, modelo, idx_key, api_key = enfriados[0]
+    espera = hasta - time.time()
+    if espera > MAX_ESPERA_ENFRIAMIENTO:
+        raise ValueError(
+            "Cuota de Gemini agotada en todas las keys/modelos. "
+            f"La primera se libera en ~{int(espera // 60) + 1} min."
+        )
+    if espera > 0:
+        st.warning(f"Cuota temporal agotada en todas las keys/modelos. Esperando {int(espera) + 1}s...")
+        time.sleep(espera)
+    return [(modelo, idx_key, api_key)]
+
+
+# ===== Caché de respuestas (opt-in en .streamlit/secrets.toml) =====
+#   gemini_cache = true
+#   gemini_cache_ttl_hours = 24   (0 = sin vencimiento)
+#   gemini_cache_mb = 64
+# Clave: hash del modelo + payload canónico (JSON con claves ordenadas).
+# Solo se guardan respuestas válidas; expulsión LRU por tamaño (utils_cache).
+_CACHE_RESPUESTAS: Optional[DiskCache] = None
+_CACHE_RESPUESTAS_LISTA = False
+_CACHE_RESPUESTAS_LOCK = threading.Lock()
+
+
+def _secreto_bool(valor) -> bool:
+    if isinstance(valor, str):
+        return valor.strip().lower() in {"1", "true", "yes", "si", "sí", "on"}
+    return bool(valor)
+
+
+def _cache_respuestas() -> Optional[DiskCache]:
+    global _CACHE_RESPUESTAS, _CACHE_RESPUESTAS_LISTA
+    with _CACHE_RESPUESTAS_LOCK:
+        if not _CACHE_RESPUESTAS_LISTA:
+            _CACHE_RESPUESTAS_LISTA = True
+            try:
+                activa = _secreto_bool(st.secrets.get("gemini_cache", False))
+                ttl_horas = float(st.secrets.get("gemini_cache_ttl_hours", 24))
+                max_mb = float(st.secrets.get("gemini_cache_mb", 64))
+            except Exception:
+                activa = False
+            if activa:
+                _CACHE_RESPUESTAS = DiskCache(
+                    "gemini",
+                    max_bytes=int(max_mb * 1024 * 1024),
+                    ttl_seconds=ttl_horas * 3600 if ttl_horas > 0 else None,
+                )
+        return _CACHE_RESPUESTAS
+
+
+def _clave_respuesta(modelo: str, prompt_dict) -> str:
+    canonico = json.dumps(
+        {"model": modelo, "payload": prompt_dict}, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(canonico.encode("utf-8")).hexdigest()
+
+
+def gemini_fanout_default() -> bool:
+    """Valor inicial del modo fan-out por categoría (secreto gemini_fanout, apagado por defecto)."""
+    try:
+        return _secreto_bool(st.secrets.get("gemini_fanout", False))
+    except Exception:
+        return False
+
+
+def gemini_cache_enabled() -> bool:
+    return _cache_respuestas() is not None
+
+
+def gemini_cache_stats() -> Optional[Dict]:
+    """Estadísticas de la caché de respuestas (None si no está habilitada)."""
+    cache = _cache_respuestas()
+    return cache.stats() if cache is not None else None
+
+
+def enviar_a_gemini(prompt_dict, max_intentos=4, espera_inicial=2, usar_cache=True):
+    """
+    POST generateContent con rotación de keys/modelos y reintentos.
+    El orden de keys/modelos sale del registro de salud (_SALUD): se empieza
+    por la opción más sana, se saltan las que están enfriadas por cuota y las
+    keys inválidas, y ante cuota agotada se cambia de key/modelo sin esperar.
+    Con la caché habilitada, un payload idéntico ya respondido (por cualquiera
+    de los modelos configurados) se devuelve sin llamar a la API.
+    usar_cache=False fuerza una generación nueva (y refresca la caché).
+    """
     api_keys = _obtener_api_keys_gemini()
     modelos = _obtener_modelos_gemini()
     estados_reintentables = {429, 500, 502, 503, 504}
     ultimo_error = None
 
-    for modelo in modelos:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{modelo}:generateContent"
-
-        for idx_key, api_key in enumerate(api_keys, start=1):
-            headers = {
-                "Content-Type": "application/json",
-                "X-goog-api-key": api_key,
-            }
-            for intento in range(1, max_intentos + 1):
-                response = None
-                try:
-                    response = requests.post(url, headers=headers, json=prompt_dict, timeout=60)
-                    response.raise_for_status()
-                    return response.json()
-                except requests.exceptions.HTTPError as e:
-                    status, mensaje, razon, metrica, detalle, retry_seconds = _parsear_error_http(response)
-                    ultimo_intento = intento == max_intentos
-                    hay_mas_keys = idx_key < len(api_keys)
-                    hay_mas_modelos = modelo != modelos[-1]
-
-                    if razon == "API_KEY_INVALID" or "api key expired" in mensaje.lower():
-                        ultimo_error = (
-                            f"Error HTTP {status}: API key invalida/expirada. "
-                            f"Modelo: {modelo}. Detalle: {detalle}"
-                        )
-                        if hay_mas_keys:
-                            st.warning(
-                                f"API key {idx_key}/{len(api_keys)} invalida o expirada. "
-                                "Probando siguiente key..."
-                            )
-                            break
-                        raise ValueError(f"Error HTTP al invocar Gemini ({status}): {mensaje}")
-
-                    if status == 429 and _es_cuota_agotada(mensaje):
-                        if not ultimo_intento and retry_seconds:
-                            st.warning(
-                                f"Gemini alcanzó limite temporal de cuota ({metrica or 'quota'}). "
-                                f"Reintentando en {retry_seconds}s..."
-                            )
-                            time.sleep(retry_seconds)
-                            continue
-
-                        ultimo_error = (
-                            "Error HTTP 429: cuota agotada para el proyecto/key actual. "
-                            f"Metrica: {metrica or 'desconocida'}. Modelo: {modelo}."
-                        )
-                        if hay_mas_keys:
-                            st.warning(
-                                f"Cuota agotada en key {idx_key}/{len(api_keys)} (modelo {modelo}). "
-                                "Probando siguiente key..."
-                            )
-                            break
-                        if hay_mas_modelos:
-                            st.warning(
-                                f"Cuota agotada en modelo {modelo}. Probando siguiente modelo..."
-                            )
-                            break
-                        raise ValueError(
-                            "Error HTTP al invocar Gemini (429): cuota agotada. "
-                            f"Metrica: {metrica or 'desconocida'}. Mensaje: {mensaje}"
+    cliente = _cliente_gemini()
+    cache = _cache_respuestas()
+    if cache is not None and usar_cache:
+        for modelo in modelos:
+            respuesta = cache.get(_clave_respuesta(modelo, prompt_dict))
+            if respuesta is not None:
+                return respuesta
+
+    cuerpo = cliente.encode(prompt_dict)
+    candidatos = _candidatos_saludables(modelos, api_keys)
+    for n, (modelo, idx_key, api_key) in enumerate(candidatos):
+        if _SALUD.key_invalida(api_key):
+            continue  # marcada inválida en este mismo llamado (con otro modelo)
+        siguientes = [c for c in candidatos[n + 1:] if not _SALUD.key_invalida(c[2])]
+        hay_mas = bool(siguientes)
+        siguiente = "modelo" if hay_mas and siguientes[0][0] != modelo else "key"
+        for intento in range(1, max_intentos + 1):
+            response = None
+            t0 = time.perf_counter()
+            try:
+                response = cliente.post(modelo, api_key, cuerpo, timeout=60)
+                response.raise_for_status()
+                respuesta = response.json()
+                _SALUD.marcar_ok(modelo, api_key, time.perf_counter() - t0)
+                if cache is not None and respuesta_es_valida(respuesta):
+                    cache.set(_clave_respuesta(modelo, prompt_dict), respuesta)
+                return respuesta
+            except requests.exceptions.HTTPError as e:
+                status, mensaje, razon, metrica, detalle, retry_seconds, cuota_id = _parsear_error_http(response)
+                ultimo_intento = intento == max_intentos
+
+                if razon == "API_KEY_INVALID" or "api key expired" in mensaje.lower():
+                    _SALUD.marcar_key_invalida(api_key)
+                    ultimo_error = (
+                        f"Error HTTP {status}: API key invalida/expirada. "
+                        f"Modelo: {modelo}. Detalle: {detalle}"
+                    )
+                    if any(c[2] != api_key for c in siguientes):
+                        st.warning(
+                            f"API key {idx_key}/{len(api_keys)} invalida o expirada. "
+                            "Probando siguiente key..."
                         )
-
-                    if status in estados_reintentables and not ultimo_intento:
-                        retry_after = response.headers.get("Retry-After") if response is not None else None
-                        if retry_after:
-                            try:
-                                espera = max(1, int(round(float(retry_after))))
-                            except Exception:
-                                espera = espera_inicial * (2 ** (intento - 1))
-                        elif retry_seconds:
-                            espera = retry_seconds
-                        else:
-                            espera = espera_inicial * (2 ** (intento - 1))
+                        break
+                    raise ValueError(f"Error HTTP al invocar Gemini ({status}): {mensaje}")
+
+                if status == 429 and _es_cuota_agotada(mensaje):
+                    _SALUD.marcar_cuota(modelo, api_key, _enfriamiento_cuota(metrica, cuota_id, retry_seconds))
+                    # Con otra key/modelo disponible se cambia de inmediato en vez de esperar
+                    diaria = _es_cuota_diaria(metrica, cuota_id)
+                    if not hay_mas and not ultimo_intento and retry_seconds and not diaria:
                         st.warning(
-                            f"Gemini devolvio {status}. Reintentando en {espera}s "
-                            f"(intento {intento}/{max_intentos}, key {idx_key}/{len(api_keys)}, modelo {modelo})..."
+                            f"Gemini alcanzó limite temporal de cuota ({metrica or 'quota'}). "
+                            f"Reintentando en {retry_seconds}s..."
                         )
-                        time.sleep(espera)
+                        time.sleep(retry_seconds)
                         continue
 
-                    raise ValueError(
-                        f"Error HTTP al invocar Gemini ({status}): {mensaje or e}. Detalle: {detalle}"
+                    ultimo_error = (
+                        "Error HTTP 429: cuota agotada para el proyecto/key actual. "
+                        f"Metrica: {metrica or 'desconocida'}. Modelo: {modelo}."
                     )
-                except requests.exceptions.Timeout:
-                    if intento < max_intentos:
-                        espera = espera_inicial * (2 ** (intento - 1))
+                    if hay_mas:
                         st.warning(
-                            f"Timeout al invocar Gemini. Reintentando en {espera}s "
-                            f"(intento {intento}/{max_intentos}, key {idx_key}/{len(api_keys)}, modelo {modelo})..."
+                            f"Cuota agotada en key {idx_key}/{len(api_keys)} (modelo {modelo}). "
+                            f"Probando siguiente {siguiente}..."
                         )
-                        time.sleep(espera)
-                        continue
-                    ultimo_error = "Timeout al invocar Gemini tras varios intentos."
-                    break
-                except Exception as e:
-                    raise ValueError(f"Error general al invocar Gemini: {e}")
+                        break
+                    raise ValueError(
+                        "Error HTTP al invocar Gemini (429): cuota agotada. "
+                        f"Metrica: {metrica or 'desconocida'}. Mensaje: {mensaje}"
+                    )
+
+                _SALUD.marcar_error(modelo, api_key)
+                if status in estados_reintentables and not ultimo_intento:
+                    retry_after = response.headers.get("Retry-After") if response is not None else None
+                    if retry_after:
+                        try:
+                            espera = max(1, int(round(float(retry_after))))
+                        except Exception:
+                            espera = espera_inicial * (2 ** (intento - 1))
+                    elif retry_seconds:
+                        espera = retry_seconds
+                    else:
+                        espera = espera_inicial * (2 ** (intento - 1))
+                    st.warning(
+                        f"Gemini devolvio {status}. Reintentando en {espera}s "
+                        f"(intento {intento}/{max_intentos}, key {idx_key}/{len(api_keys)}, modelo {modelo})..."
+                    )
+                    time.sleep(espera)
+                    continue
+
+                raise ValueError(
+                    f"Error HTTP al invocar Gemini ({status}): {mensaje or e}. Detalle: {detalle}"
+                )
+            except requests.exceptions.Timeout:
+                _SALUD.marcar_error(modelo, api_key)
+                if intento < max_intentos:
+                    espera = espera_inicial * (2 ** (intento - 1))
+                    st.warning(
+                        f"Timeout al invocar Gemini. Reintentando en {espera}s "
+                        f"(intento {intento}/{max_intentos}, key {idx_key}/{len(api_keys)}, modelo {modelo})..."
+                    )
+                    time.sleep(espera)
+                    continue
+                ultimo_error = "Timeout al invocar Gemini tras varios intentos."
+                break
+            except Exception as e:
+                raise ValueError(f"Error general al invocar Gemini: {e}")
 
     raise ValueError(ultimo_error or "Gemini no respondio tras varios intentos.")
 
 
-def limitar_texto_para_gemini(texto_funcional: str, max_chars: int = 18000) -> str:
-    """Reduce el contexto para evitar agotar cuota de tokens en free tier."""
+def respuesta_desde_texto(texto: str) -> Dict:
+    """Respuesta con la forma de generateContent armada desde el texto completo (caché / streaming)."""
+    return {"candidates": [{"content": {"parts": [{"text": texto}], "role": "model"}}]}
+
+
+def _eventos_sse(response) -> Iterator[Dict]:
+    """Eventos JSON de un stream SSE (líneas "data: ..." terminadas por una línea vacía)."""
+    datos = []
+    for linea in response.iter_lines():
+        if linea:
+            if linea.startswith(b"data:"):
+                datos.append(linea[5:].strip())
+            continue
+        if datos:
+            yield json.loads(b"".join(datos).decode("utf-8"))
+            datos = []
+    if datos:
+        yield json.loads(b"".join(datos).decode("utf-8"))
+
+
+def _texto_de_evento(evento: Dict) -> str:
+    try:
+        partes = evento["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    return "".join(p.get("text", "") for p in partes if isinstance(p, dict))
+
+
+def enviar_a_gemini_stream(prompt_dict, usar_cache=True, timeout=60) -> Iterator[str]:
+    """
+    Variante en streaming de enviar_a_gemini (streamGenerateContent?alt=sse):
+    genera los trozos de texto a medida que llegan. Cerrar el generador
+    (break / close) corta la conexión: sirve para abortar una mala respuesta.
+    - Caché: un payload ya respondido sale de la caché como un solo trozo; al
+      terminar el stream la respuesta completa se guarda como en enviar_a_gemini.
+    - Recorre keys/modelos en el orden del registro de salud y le informa
+      cuotas, keys inválidas y errores.
+    - Si ninguna key/modelo abre el stream (cuota, HTTP, red), se recurre a
+      enviar_a_gemini (con todos sus reintentos) y se entrega el texto de una vez.
+    - Un corte después del primer trozo se informa con ValueError.
+    - Un stream 200 que termina sin texto es la respuesta (vacía): no genera
+      trozos ni se repite con otras keys/modelos.
+    """
+    cliente = _cliente_gemini()
+    cache = _cache_respuestas()
+    modelos = _obtener_modelos_gemini()
+    if cache is not None and usar_cache:
+        for modelo in modelos:
+            respuesta = cache.get(_clave_respuesta(modelo, prompt_dict))
+            if respuesta is not None:
+                yield _texto_de_evento(respuesta)
+                return
+
+    cuerpo = cliente.encode(prompt_dict)
+    disponibles, _ = _SALUD.orden(modelos, _obtener_api_keys_gemini())
+    for modelo, _, api_key in disponibles:
+        if _SALUD.key_invalida(api_key):
+            continue
+        try:
+            response = cliente.post(
+                modelo, api_key, cuerpo, metodo="streamGenerateContent",
+                timeout=timeout, params={"alt": "sse"}, stream=True
+            )
+        except requests.exceptions.RequestException:
+            _SALUD.marcar_error(modelo, api_key)
+            continue
+        if response.status_code != 200:
+            _, mensaje, razon, metrica, _, retry_seconds, cuota_id = _parsear_error_http(response)
+            if razon == "API_KEY_INVALID" or "api key expired" in mensaje.lower():
+                _SALUD.marcar_key_invalida(api_key)
+            elif response.status_code == 429 and _es_cuota_agotada(mensaje):
+                _SALUD.marcar_cuota(modelo, api_key, _enfriamiento_cuota(metrica, cuota_id, retry_seconds))
+            else:
+                _SALUD.marcar_error(modelo, api_key)
+            response.close()
+            continue
+
+        partes = []
+        try:
+            for evento in _eventos_sse(response):
+                trozo = _texto_de_evento(evento)
+                if trozo:
+                    partes.append(trozo)
+                    yield trozo
+        except (requests.exceptions.RequestException, ValueError) as e:
+            _SALUD.marcar_error(modelo, api_key)
+            if not partes:
+                continue  # aún no se entregó nada: se prueba la siguiente key/modelo
+            raise ValueError(f"Stream de Gemini interrumpido: {e}")
+        finally:
+            response.close()
+
+        # Un 200 completo sin texto es la respuesta final (vacía): no se reintenta
+        # con cada key/modelo ni con el camino clásico; el llamador decide
+        _SALUD.marcar_ok(modelo, api_key)
+        if partes and cache is not None:
+            respuesta = respuesta_desde_texto("".join(partes))
+            cache.set(_clave_respuesta(modelo, prompt_dict), respuesta)
+        return
+
+    # Sin stream disponible: camino clásico con reintentos y rotación de keys/modelos
+    yield _texto_de_evento(enviar_a_gemini(prompt_dict, usar_cache=False))
+
+
+def _contexto_streamlit():
+    """Contexto del script de Streamlit actual (para st.warning desde hilos), si existe."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        return get_script_run_ctx()
+    except Exception:
+        return None
+
+
+def _adjuntar_contexto(ctx) -> None:
+    if ctx is None:
+        return
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx
+        add_script_run_ctx(threading.current_thread(), ctx)
+    except Exception:
+        pass
+
+
+def generar_escenarios_en_paralelo(
+    descripcion_refinada,
+    contexto_original="",
+    target_cases=20,
+    min_cases=8,
+    consulta=None,
+    usar_cache=True,
+    categorias=None,
+) -> List[Tuple[Dict, Optional[str], Optional[Exception]]]:
+    """
+    Fan-out: un sub-prompt por categoría de cobertura, enviados a la vez
+    (un hilo por categoría, misma sesión HTTP). El tiempo total es el de la
+    respuesta más lenta, no la suma.
+    Devuelve [(categoria, texto_csv, error)] en el orden de las categorías;
+    una categoría que falla trae error y no corta a las demás.
+    """
+    reparto = repartir_casos(target_cases, min_cases, categorias)
+    ctx = _contexto_streamlit()
+
+    def generar(item):
+        categoria, minimo, objetivo = item
+        try:
+            respuesta = enviar_a_gemini(
+                prompt_generar_escenarios_profesionales(
+                    descripcion_refinada,
+                    contexto_original=contexto_original,
+                    target_cases=objetivo,
+                    min_cases=minimo,
+                    consulta=consulta,
+                    categoria=categoria,
+                ),
+                usar_cache=usar_cache,
+            )
+            return categoria, extraer_texto_de_respuesta_gemini(respuesta).strip(), None
+        except Exception as e:
+            return categoria, None, e
+
+    with ThreadPoolExecutor(
+        max_workers=len(reparto), thread_name_prefix="qa_gemini", initializer=_adjuntar_contexto, initargs=(ctx,)
+    ) as pool:
+        return list(pool.map(generar, reparto))
+
+
+def limitar_texto_para_gemini(texto_funcional: str, max_chars: int = 18000, query: str = None) -> str:
+    """
+    Reduce el contexto para evitar agotar cuota de tokens en free tier.
+    Con query (texto funcional del usuario) no corta por posición: conserva los
+    trozos más relevantes (BM25) en su orden original (utils_context).
+    """
     if not texto_funcional:
         return ""
     texto = texto_funcional.strip()
     if len(texto) <= max_chars:
         return texto
+    if query:
+        empaquetado = pack_by_relevance(texto, query, max_chars)
+        if empaquetado:
+            return empaquetado + "\n\n[RECORTADO_POR_RELEVANCIA]"
     return texto[:max_chars] + "\n\n[TRUNCADO_POR_LIMITE_DE_CUOTA]"
 
 
@@ -529,7 +1121,10 @@ def obtener_descripcion_refinada(texto_funcional, max_intentos=3):
         )
     intentos = 0
     while intentos < max_intentos:
-        respuesta_estructurada = enviar_a_gemini(prompt_refinar_descripcion(texto_ajustado))
+        # Reintento por respuesta vacía: ya no sirve la caché
+        respuesta_estructurada = enviar_a_gemini(
+            prompt_refinar_descripcion(texto_ajustado), usar_cache=intentos == 0
+        )
         descripcion_refinada = extraer_texto_de_respuesta_gemini(respuesta_estructurada).strip()
 
         if descripcion_refinada:
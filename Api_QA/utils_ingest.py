@@ -2,25 +2,47 @@
 # ---------------------------------------------
 # Extracción de texto desde adjuntos para usar como contexto en la generación
 # - PDF:     PyMuPDF (texto nativo) + OCR por página con Tesseract si no hay texto
-# - DOCX:    python-docx
+# - DOCX:    word/document.xml por eventos (python-docx como respaldo)
 # - TXT/CSV: decodificación estándar
-# - XLSX:    pandas -> CSV
+# - XLSX:    openpyxl read_only -> CSV en streaming (pandas como respaldo)
 # - IMAGEN:  OCR con Tesseract
 # ---------------------------------------------
 
 import io
+import os
 import csv
+import time
 import hashlib
 import platform
 import shutil
-from typing import List, Dict, Tuple
+import tempfile
+import threading
+import subprocess
+import zipfile
+import functools
+import xml.etree.ElementTree as ET
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Dict, Tuple, Optional
 
+import numpy as np
 import pandas as pd
 import fitz  # PyMuPDF
 
+from utils_cache import DiskCache
+from utils_context import (
+    DEDUP_CHUNKS, PACK_EXTRACT_FACTOR, STRIP_BOILERPLATE, BoilerplateFilter, NearDuplicateFilter, pack_sources,
+    query_terms,
+)
+from utils_pages import RENDER_ZOOM, PdfPages, page_cache_stats, pdf_pages, release_pages
+from utils_uploads import Content, UploadBlob, as_buffer, as_stream
+
 # ===== OCR (Tesseract) =====
 try:
-    from PIL import Image
+    from PIL import Image, ImageChops, ImageOps
     import pytesseract
 
     # Config multiplataforma: en Windows fijamos ruta; en Linux/Mac usamos PATH
@@ -34,199 +56,1285 @@ try:
 except Exception:
     _OCR_OK = False
     Image = None
+    ImageChops = None
+    ImageOps = None
     pytesseract = None
 
+# Backend OCR:
+# - "batch":       un solo proceso tesseract por lote de imágenes (lista de archivos),
+#                  el modelo spa+eng se carga una vez por lote y no por página
+# - "pytesseract": un proceso por imagen (comportamiento original)
+OCR_BACKEND = os.environ.get("QA_OCR_BACKEND", "batch")
+OCR_BATCH_SIZE = int(os.environ.get("QA_OCR_BATCH_SIZE", "16") or 16)
+
+# Preparación de imágenes sueltas (fotos, capturas) antes del OCR:
+# Tesseract rinde mejor con líneas de texto de ~30-40 px de alto; más resolución
+# solo agrega tiempo. El tope de megapíxeles acota el costo por imagen.
+OCR_TARGET_LINE_PX = 36
+OCR_MAX_PIXELS = int(float(os.environ.get("QA_OCR_MAX_MP", "6") or 6) * 1_000_000)
+_IMG_ESCALA_MIN, _IMG_ESCALA_MAX = 0.2, 2.0
+_IMG_TOLERANCIA_BORDE = 24      # diferencia de gris que aún cuenta como borde uniforme
+_IMG_MARGEN = 10                # margen que se devuelve tras recortar (Tesseract lo prefiere)
+
+# Idioma OCR: "auto" elige por documento el modelo más barato suficiente
+# ("spa", "eng" o "spa+eng"); cualquier otro valor (QA_OCR_LANG o el
+# parámetro ocr_lang) se usa tal cual.
+OCR_AUTO = "auto"
+OCR_LANG_DEFAULT = "spa+eng"
+_IDIOMA_MIN_PALABRAS = 8        # palabras funcionales mínimas para decidir
+_IDIOMA_DOMINANTE = 0.85        # proporción para quedarse con un solo idioma
+_IDIOMA_MAX_SONDAS = 3          # páginas sondeadas con spa+eng antes de rendirse
+_SONDA_MIN_PIXELS = 1_500_000   # imágenes menores: una sola pasada spa+eng
+_FUNCIONALES = {
+    "spa": set("de la que el en los del las por con una para es se al lo su como más pero sus le ya o este"
+               " esta entre cuando muy sin sobre también hasta donde desde todo nos durante según".split()),
+    "eng": set("the and of to in is for that with on are be by this it as or an at from was which have"
+               " has not but all can will their been would there should must when each".split()),
+}
+
 # ===== Extractores auxiliares =====
 try:
     import docx  # python-docx
 except Exception:
     docx = None
 
+try:
+    import openpyxl
+except Exception:
+    openpyxl = None
+
+# ===== Memoria pico del proceso (telemetría) =====
+try:
+    import resource  # Linux / Mac
+except Exception:
+    resource = None
+
+try:
+    import psutil  # opcional (Windows)
+except Exception:
+    psutil = None
+
 SUPPORTED_DOCS = {".pdf", ".docx", ".txt", ".csv", ".xlsx"}
 SUPPORTED_IMAGES = {".png", ".jpg", ".jpeg", ".webp", ".tiff", ".tif"}
 
+# ===== Pool de procesos para extracción paralela =====
+# Compartido por todas las sesiones del proceso: acota el total de workers
+# aunque varios usuarios procesen adjuntos a la vez. Configurable por entorno.
+INGEST_MAX_WORKERS = int(os.environ.get("QA_INGEST_WORKERS", "0") or 0) or min(8, os.cpu_count() or 1)
+
+# OCR de PDFs escaneados por página: tope de workers que puede ocupar un
+# solo documento, para que una subida grande no acapare el pool.
+PDF_OCR_MAX_WORKERS = int(os.environ.get("QA_PDF_OCR_WORKERS", "0") or 0) or min(4, INGEST_MAX_WORKERS)
+PDF_OCR_MIN_PAGES = 3
+
+# Clasificador previo al OCR: se saltan páginas vacías y páginas cuya tinta
+# no forma ninguna línea de texto (logos, sellos, portadas decorativas). Ante
+# cualquier racha de filas con altura de línea, o con letras separadas, OCR.
+# Render gris a 1/2: una línea de texto de 6 pt ya ocupa ~3 filas.
+_CLASIF_ESCALA = 0.5
+_CLASIF_UMBRAL_TINTA = 200        # gris < umbral cuenta como tinta (incluye texto gris claro)
+_CLASIF_MIN_OSCUROS_FILA = 3      # píxeles con tinta para que una fila cuente (ignora motas)
+_CLASIF_MAX_TINTA = 0.0002        # fracción de tinta tolerada en una página vacía (motas del escáner)
+_CLASIF_MAX_ALTO_LINEA = 20       # filas (~40 pt): una racha más alta es un bloque, no una línea
+_CLASIF_MIN_TRAZOS = 4            # tramos de tinta por fila para que parezca texto (letras separadas)
+_CLASIF_VALLE = 0.35              # fila con menos tinta que esto × mediana del bloque: interlineado
+
+# ===== Caché de extracción =====
+# Clave: hash completo del contenido + extensión + versión del extractor +
+# idioma OCR. Subir EXTRACTOR_VERSION cuando cambie la salida de un extractor.
+EXTRACTOR_VERSION = "11"
+OCR_LANG = os.environ.get("QA_OCR_LANG", "auto")
+EXTRACT_CACHE_MAX_MB = int(os.environ.get("QA_EXTRACT_CACHE_MB", "512") or 0)
+_EXTRACT_CACHE = DiskCache("extract", max_bytes=EXTRACT_CACHE_MAX_MB * 1024 * 1024) if EXTRACT_CACHE_MAX_MB > 0 else None
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+# ===== Telemetría de ingesta =====
+# Tiempos por etapa (ms) en meta["timings_ms"]: open, text, classify, render,
+# ocr, ocr_wall, parse, cache, total. Agregados del proceso en ocr_diagnostics().
+TELEMETRY_WINDOW = 200  # últimas N extracciones para percentiles de latencia
+_TELEMETRIA_LOCK = threading.Lock()
+_TELEMETRIA: Dict = {}
+_LATENCIAS: deque = deque(maxlen=TELEMETRY_WINDOW)
+
+# ===== Progreso y cancelación (utils_jobs) =====
+_AVISOS = threading.local()
+
+
+class IngestCancelled(Exception):
+    """La ingesta se canceló desde un callback de progreso."""
+
 
 def _ext(name: str) -> str:
     i = name.rfind(".")
     return name[i:].lower() if i != -1 else ""
 
 
-def _sha1_8(b: bytes) -> str:
+def _sha1_8(b: Content) -> str:
+    if isinstance(b, UploadBlob):
+        return b.sha1_8
     return hashlib.sha1(b).hexdigest()[:8]
 
 
+def _sha256(b: Content) -> str:
+    if isinstance(b, UploadBlob):
+        return b.sha256
+    return hashlib.sha256(b).hexdigest()
+
+
+def _sumar_ms(stats: Optional[Dict], etapa: str, ms: float) -> None:
+    if stats is not None:
+        tiempos = stats.setdefault("timings_ms", {})
+        tiempos[etapa] = round(tiempos.get(etapa, 0.0) + ms, 1)
+
+
+@contextmanager
+def _etapa(stats: Optional[Dict], etapa: str):
+    """Acumula en stats["timings_ms"][etapa] el tiempo del bloque (ms)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _sumar_ms(stats, etapa, (time.perf_counter() - t0) * 1000)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Memoria residente pico del proceso actual (worker o principal), en MB."""
+    try:
+        if resource is not None:
+            pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Linux informa KB; Mac, bytes
+            return round(pico / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+        if psutil is not None:
+            info = psutil.Process().memory_info()
+            return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except Exception:
+        pass
+    return None
+
+
+@contextmanager
+def pages_progress(callback: Callable[[int, int], None]):
+    """
+    Mientras dura el bloque, los PDF extraídos en este hilo informan
+    callback(páginas_hechas, páginas_totales) por tramos. El callback puede
+    lanzar IngestCancelled para abortar la extracción.
+    """
+    previo = getattr(_AVISOS, "paginas", None)
+    _AVISOS.paginas = callback
+    try:
+        yield
+    finally:
+        _AVISOS.paginas = previo
+
+
+def _avisar_paginas(hechas: int, total: int) -> None:
+    callback = getattr(_AVISOS, "paginas", None)
+    if callback is not None:
+        callback(hechas, total)
+
+
+def _detectar_idioma(texto: str) -> Optional[str]:
+    """
+    "spa", "eng" o "spa+eng" según las palabras funcionales del texto;
+    None si no hay evidencia suficiente.
+    """
+    cuenta = {idioma: 0 for idioma in _FUNCIONALES}
+    for palabra in texto.lower().split():
+        for idioma, funcionales in _FUNCIONALES.items():
+            if palabra.strip(".,;:()\"'¿?¡!") in funcionales:
+                cuenta[idioma] += 1
+    total = sum(cuenta.values())
+    if total < _IDIOMA_MIN_PALABRAS:
+        return None
+    idioma, n = max(cuenta.items(), key=lambda kv: kv[1])
+    return idioma if n / total >= _IDIOMA_DOMINANTE and _idioma_disponible(idioma) else OCR_LANG_DEFAULT
+
+
+@functools.lru_cache(maxsize=1)
+def _idiomas_instalados() -> Optional[frozenset]:
+    try:
+        return frozenset(pytesseract.get_languages(config=""))
+    except Exception:
+        return None  # desconocido: se asume disponible
+
+
+def _idioma_disponible(lang: str) -> bool:
+    instalados = _idiomas_instalados() if _OCR_OK else None
+    return instalados is None or all(parte in instalados for parte in lang.split("+"))
+
+
+def _cache_key(digest: str, ext: str, lang: str, strip_boilerplate: bool = STRIP_BOILERPLATE) -> str:
+    bp = ":bp" if strip_boilerplate else ""
+    return f"{digest}:{ext}:v{EXTRACTOR_VERSION}{bp}:{lang}"
+
+
+def _guardar_raster(raster, ruta_base: str) -> str:
+    """
+    Escribe un raster para tesseract. Un Pixmap de PyMuPDF se vuelca como
+    PGM/PPM sin comprimir directamente desde su buffer de muestras (sin pasar
+    por PNG ni por copias en PIL); una imagen PIL se guarda como PNG.
+    """
+    if isinstance(raster, fitz.Pixmap):
+        gris = raster.n == 1
+        ruta = ruta_base + (".pgm" if gris else ".ppm")
+        fila = raster.width * raster.n
+        with open(ruta, "wb") as fh:
+            fh.write(f"P{5 if gris else 6}\n{raster.width} {raster.height}\n255\n".encode("ascii"))
+            muestras = raster.samples_mv
+            if raster.stride == fila:
+                fh.write(muestras)
+            else:
+                for y in range(raster.height):
+                    fh.write(muestras[y * raster.stride: y * raster.stride + fila])
+        return ruta
+    ruta = ruta_base + ".png"
+    raster.save(ruta)
+    return ruta
+
+
+def _pil_view(raster):
+    """Vista PIL sobre las muestras de un Pixmap (sin copiar); el Pixmap debe seguir vivo."""
+    if not isinstance(raster, fitz.Pixmap):
+        return raster
+    modo = "L" if raster.n == 1 else "RGB"
+    return Image.frombuffer(modo, (raster.width, raster.height), raster.samples_mv, "raw", modo, raster.stride, 1)
+
+
+def _ocr_batch_tesseract(rutas: List[str], lang: str, tmp: str) -> List[str]:
+    """
+    Ejecuta tesseract una sola vez sobre un lote de archivos ya escritos en
+    tmp, pasándole la lista. La salida trae una página por imagen separadas
+    por form feed.
+    """
+    lista = os.path.join(tmp, "lista.txt")
+    with open(lista, "w", encoding="utf-8") as fh:
+        fh.write("\n".join(rutas) + "\n")
+
+    cmd = [pytesseract.pytesseract.tesseract_cmd, lista, "stdout", "-l", lang]
+    proc = subprocess.run(cmd, capture_output=True, check=True)
+
+    paginas = proc.stdout.decode("utf-8", errors="ignore").split("\f")
+    if len(paginas) < len(rutas):
+        raise RuntimeError(f"tesseract devolvió {len(paginas)} páginas para {len(rutas)} imágenes")
+    return [p.strip() for p in paginas[: len(rutas)]]
+
+
+def _ocr_lote(rutas: List[str], lang: str, tmp: str) -> List[str]:
+    try:
+        return _ocr_batch_tesseract(rutas, lang, tmp)
+    except Exception:
+        return [(pytesseract.image_to_string(ruta, lang=lang) or "").strip() for ruta in rutas]
+    finally:
+        for ruta in rutas:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+def _ocr_images(rasters, lang: str = "spa+eng") -> List[str]:
+    """
+    OCR de varios rasters (imágenes PIL o Pixmaps de PyMuPDF; acepta un
+    iterable perezoso). Con el backend "batch" cada raster se escribe a disco
+    al llegar y se agrupan de a OCR_BATCH_SIZE por proceso tesseract; si el
+    lote falla se reintenta archivo por archivo con pytesseract.
+    """
+    if not _OCR_OK:
+        return ["" for _ in rasters]
+    if OCR_BACKEND != "batch":
+        return [(pytesseract.image_to_string(_pil_view(r), lang=lang) or "").strip() for r in rasters]
+
+    out: List[str] = []
+    with tempfile.TemporaryDirectory(prefix="qa_ocr_") as tmp:
+        rutas: List[str] = []
+        for i, raster in enumerate(rasters):
+            rutas.append(_guardar_raster(raster, os.path.join(tmp, f"p{i:05d}")))
+            if len(rutas) >= OCR_BATCH_SIZE:
+                out.extend(_ocr_lote(rutas, lang, tmp))
+                rutas = []
+        if rutas:
+            out.extend(_ocr_lote(rutas, lang, tmp))
+    return out
+
+
 def _ocr_image_bytes(img_bytes: bytes, lang: str = "spa+eng") -> str:
     if not _OCR_OK:
         return ""
     im = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    return (pytesseract.image_to_string(im, lang=lang) or "").strip()
+    return _ocr_images([im], lang=lang)[0]
 
 
 # ---------------- PDF ----------------
-def _from_pdf(b: bytes, lang: str = "spa+eng") -> str:
+def _rachas(mascara) -> List[Tuple[int, int]]:
+    """[(inicio, fin)] de las rachas de True de un vector booleano."""
+    bordes = np.diff(np.concatenate(([0], mascara.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(bordes == 1), np.flatnonzero(bordes == -1)))
+
+
+def _bloque_tiene_lineas(tinta, cuenta) -> bool:
+    """
+    True si un bloque de filas con tinta más alto que una línea contiene
+    texto: una franja de altura de línea con letras separadas (membrete junto
+    a un logo), o líneas separadas por interlineado (párrafo compacto).
+    """
+    trazos = (np.diff(tinta.astype(np.int8), axis=1) == 1).sum(axis=1)
+    for ini, fin in _rachas(trazos >= _CLASIF_MIN_TRAZOS):
+        if 2 <= fin - ini <= _CLASIF_MAX_ALTO_LINEA:
+            return True
+    lineas = _rachas(cuenta >= _CLASIF_VALLE * np.median(cuenta))
+    if len(lineas) == 1 and lineas[0] == (0, len(cuenta)):
+        return False  # perfil sin valles: logo, sello o portada
+    return any(fin - ini <= _CLASIF_MAX_ALTO_LINEA for ini, fin in lineas)
+
+
+def _page_likely_has_text(page) -> bool:
+    """
+    Clasificador barato para páginas sin capa de texto, sobre el perfil de
+    filas con tinta de un render gris a 1/2 (invertido si el fondo es oscuro,
+    como en _alto_de_linea). False si la página está vacía (sin imágenes ni
+    dibujos, o apenas motas) o si la tinta solo forma bloques sin líneas de
+    texto: un logo, un sello, una portada. Una racha de altura de línea (una
+    palabra, una línea de firma) o un bloque con líneas dentro va a OCR.
+    """
+    try:
+        if not page.get_image_info() and not page.get_drawings():
+            return False
+
+        pix = page.get_pixmap(matrix=fitz.Matrix(_CLASIF_ESCALA, _CLASIF_ESCALA), colorspace=fitz.csGRAY, alpha=False)
+        if not pix.width or not pix.height:
+            return False
+        arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+        if arr.mean() < 128:  # texto claro sobre fondo oscuro
+            arr = 255 - arr
+        tinta = arr < _CLASIF_UMBRAL_TINTA
+        cuenta = tinta.sum(axis=1)
+
+        filas = cuenta >= _CLASIF_MIN_OSCUROS_FILA
+        if not filas.any():
+            return tinta.mean() > _CLASIF_MAX_TINTA
+        for ini, fin in _rachas(filas):
+            if fin - ini <= _CLASIF_MAX_ALTO_LINEA:
+                return True
+            if _bloque_tiene_lineas(tinta[ini:fin], cuenta[ini:fin]):
+                return True
+        return False
+    except Exception:
+        return True  # ante la duda, OCR
+
+
+def _ocr_doc_pages(paginas: PdfPages, pages: List[int], lang: str = "spa+eng", stats: Optional[Dict] = None) -> Dict[int, str]:
+    """
+    OCR de varias páginas de un documento abierto, renderizadas a medida que el backend las pide.
+    Raster gris x2 (el Pixmap va tal cual al backend OCR), tomado de la caché de
+    páginas si el preview o una extracción anterior ya lo generó.
+    stats (opcional) acumula los tiempos de render y de OCR por separado.
+    """
+    render_ms = 0.0
+
+    def rasters():
+        nonlocal render_ms
+        for pno in pages:
+            t0 = time.perf_counter()
+            raster = paginas.gray(pno, RENDER_ZOOM)
+            render_ms += (time.perf_counter() - t0) * 1000
+            yield raster
+
+    t0 = time.perf_counter()
+    textos = _ocr_images(rasters(), lang=lang)
+    _sumar_ms(stats, "render", render_ms)
+    _sumar_ms(stats, "ocr", (time.perf_counter() - t0) * 1000 - render_ms)
+    return dict(zip(pages, textos))
+
+
+def _ocr_pdf_pages(b: Content, pages: List[int], lang: str = "spa+eng") -> Tuple[Dict[int, str], Dict]:
+    """Worker: abre el PDF una sola vez y hace OCR de las páginas indicadas. Devuelve (textos, tiempos)."""
+    stats: Dict = {}
+    paginas = PdfPages(b)  # sin caché: los rasters no vuelven al proceso principal
+    try:
+        with _etapa(stats, "open"):
+            paginas.doc
+        return _ocr_doc_pages(paginas, pages, lang=lang, stats=stats), stats["timings_ms"]
+    finally:
+        paginas.close()
+
+
+def _ocr_pages(paginas: PdfPages, pages: List[int], lang: str = "spa+eng", stats: Optional[Dict] = None) -> Dict[int, str]:
+    """
+    OCR de las páginas sin texto. Las ya reconocidas con ese idioma salen de
+    la caché de páginas. Con suficientes páginas sin raster en caché las
+    reparte entre hasta PDF_OCR_MAX_WORKERS procesos del pool compartido y,
+    mientras tanto, este hilo reconoce las que ya tienen raster (preview); el
+    resultado se indexa por número de página para reensamblar en orden.
+    Si un tramo falla en el pool (error de Tesseract o del PDF, tarea
+    cancelada, pool roto), solo sus páginas se reconocen aquí en serie; el
+    pool compartido se reinicia únicamente si está roto.
+    Los tiempos de los workers se suman en stats (tiempo de CPU agregado, no de reloj).
+    """
+    out: Dict[int, str] = {}
+    for pno in pages:
+        texto = paginas.ocr_text(pno, lang)
+        if texto is not None:
+            out[pno] = texto
+    pendientes = [pno for pno in pages if pno not in out]
+    sin_raster = [pno for pno in pendientes if not paginas.has_gray(pno)]
+    paralelo = (
+        _OCR_OK
+        and len(sin_raster) >= PDF_OCR_MIN_PAGES
+        and PDF_OCR_MAX_WORKERS > 1
+        and multiprocessing.parent_process() is None  # no anidar pools dentro de un worker
+    )
+    nuevos: Dict[int, str] = {}
+    futures = []
+    if paralelo:
+        n = min(PDF_OCR_MAX_WORKERS, len(sin_raster))
+        pool = None
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(_ocr_pdf_pages, paginas.content, sin_raster[i::n], lang) for i in range(n)]
+        except BrokenProcessPool:
+            _reset_pool(pool)
+        except (RuntimeError, OSError):
+            pass  # pool cerrado por otro hilo: este documento va en serie
+        if len(futures) < n:
+            for fut in futures:
+                fut.cancel()
+            futures = []
+    if futures:
+        con_raster = [pno for pno in pendientes if pno not in set(sin_raster)]
+        if con_raster:
+            nuevos.update(_ocr_doc_pages(paginas, con_raster, lang=lang, stats=stats))
+        for fut in futures:
+            try:
+                textos, tiempos = fut.result()
+            except BrokenProcessPool:
+                _reset_pool(pool)
+                continue
+            except Exception:
+                continue  # tramo fallido o cancelado: sus páginas van abajo en serie
+            nuevos.update(textos)
+            for etapa, ms in tiempos.items():
+                _sumar_ms(stats, etapa, ms)
+
+    faltantes = [pno for pno in pendientes if pno not in nuevos]
+    if faltantes:
+        nuevos.update(_ocr_doc_pages(paginas, faltantes, lang=lang, stats=stats))
+    for pno, texto in nuevos.items():
+        paginas.set_ocr_text(pno, lang, texto)
+    out.update(nuevos)
+    return out
+
+
+def _from_pdf(
+    b: Content,
+    lang: str = "spa+eng",
+    budget: Optional[int] = None,
+    stats: Optional[Dict] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+) -> str:
     """
     Extrae texto de PDF. Si una página no tiene texto (PDF escaneado), hace OCR de la página.
+    Las páginas sin texto que el clasificador descarta (blancas, logos) no pasan por OCR.
+    Con budget, recorre el documento por tramos y deja de leer/OCR en cuanto el
+    texto acumulado supera ese número de caracteres.
+    Con strip_boilerplate, los encabezados/pies que se repiten en los bordes
+    de BOILERPLATE_MIN_REPEATS páginas se quitan desde esa aparición (las
+    anteriores quedan) antes de contar el presupuesto.
+    Con lang="auto" el idioma OCR sale de la capa de texto de las páginas ya
+    leídas; si no hay, la primera página a OCR se procesa con spa+eng (su
+    resultado se usa igual) y de ella se deduce el idioma del resto.
+    Capa de texto, rasters y OCR por página salen de la caché de utils_pages,
+    compartida con el preview: el documento se abre y renderiza una sola vez.
+    stats (opcional) recibe pages, ocr_pages, ocr_pages_skipped, ocr_lang,
+    ocr_lang_source, boilerplate_chars, boilerplate_lines y los tiempos de
+    las etapas open, text, classify, render, ocr y ocr_wall.
     """
+    stats = stats if stats is not None else {}
     try:
-        doc = fitz.open(stream=b, filetype="pdf")
+        with _etapa(stats, "open"):
+            paginas = pdf_pages(b)
+            total = paginas.page_count
     except Exception:
         return ""
+    try:
+        return _from_pdf_paginas(paginas, total, lang, budget, stats, strip_boilerplate)
+    finally:
+        release_pages(paginas)
+
 
+def _from_pdf_paginas(
+    paginas: PdfPages, total: int, lang: str, budget: Optional[int], stats: Dict, strip_boilerplate: bool
+) -> str:
+    # Cuerpo de _from_pdf sobre un documento ya abierto
+
+    # Sin presupuesto ni progreso que informar: un solo tramo (todo el OCR en paralelo de una vez)
+    por_tramos = budget is not None or getattr(_AVISOS, "paginas", None) is not None
+    tramo = max(PDF_OCR_MIN_PAGES, 2 * PDF_OCR_MAX_WORKERS) if por_tramos else total
+    stats.update(pages=total, ocr_pages=0, ocr_pages_skipped=0)
+    filtro = BoilerplateFilter() if strip_boilerplate else None
+    idioma, origen = (None, None) if lang == OCR_AUTO else (lang, "override")
+    muestra = ""    # capa de texto leída hasta ahora (para detectar idioma)
+    sondas = 0
     partes = []
-    for page in doc:
-        txt = page.get_text("text") or ""
-        if not txt.strip():
-            # Render x2 para mejorar OCR
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
-            ocr_txt = _ocr_image_bytes(pix.tobytes("png"), lang=lang)
-            txt = ocr_txt or ""
-        if txt.strip():
-            partes.append(txt.strip())
-    doc.close()
+    largo = 0
+    for inicio in range(0, total, max(1, tramo)):
+        _avisar_paginas(inicio, total)
+        pnos = range(inicio, min(inicio + tramo, total))
+        with _etapa(stats, "text"):
+            textos = {pno: paginas.text(pno) for pno in pnos}
+        sin_texto = [pno for pno, txt in textos.items() if not txt.strip()]
+        a_ocr = []
+        if _OCR_OK and sin_texto:
+            with _etapa(stats, "classify"):
+                a_ocr = [pno for pno in sin_texto if paginas.classify(pno, _page_likely_has_text)]
+            stats["ocr_pages_skipped"] += len(sin_texto) - len(a_ocr)
+        if idioma is None and len(muestra) < 20_000:
+            # Toda la capa de texto leída cuenta, también la de tramos sin páginas a OCR
+            capa = "\n".join(textos[pno] for pno in pnos if pno not in sin_texto)
+            muestra = (muestra + "\n" + capa)[:20_000] if muestra else capa[:20_000]
+        if a_ocr and idioma is None:
+            idioma = _detectar_idioma(muestra)
+            origen = "text_layer" if idioma else None
+        if a_ocr:
+            stats["ocr_pages"] += len(a_ocr)
+            with _etapa(stats, "ocr_wall"):
+                while idioma is None and a_ocr:
+                    # Sonda: una página con spa+eng; su texto decide el resto
+                    sonda = _ocr_pages(paginas, a_ocr[:1], lang=OCR_LANG_DEFAULT, stats=stats)
+                    textos.update(sonda)
+                    a_ocr = a_ocr[1:]
+                    sondas += 1
+                    idioma = _detectar_idioma(" ".join(sonda.values()))
+                    origen = "probe" if idioma else None
+                    if idioma is None and sondas >= _IDIOMA_MAX_SONDAS:
+                        idioma, origen = OCR_LANG_DEFAULT, "default"
+                if a_ocr:
+                    textos.update(_ocr_pages(paginas, a_ocr, lang=idioma, stats=stats))
+
+        for pno in pnos:
+            txt = textos[pno].strip()
+            if txt and filtro is not None:
+                txt = filtro.filter_page(txt)
+            if txt:
+                largo += len(txt) + (1 if partes else 0)
+                partes.append(txt)
+        if budget is not None and largo > budget:
+            break
 
+    if stats["ocr_pages"]:
+        stats.update(ocr_lang=idioma or OCR_LANG_DEFAULT, ocr_lang_source=origen or "default")
+    if filtro is not None:
+        stats.update(boilerplate_chars=filtro.chars_saved, boilerplate_lines=filtro.report())
     return "\n".join(partes).strip()
 
 
 # ---------------- DOCX ----------------
-def _from_docx(b: bytes) -> str:
-    if docx is None:
-        return ""
-    try:
-        d = docx.Document(io.BytesIO(b))
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+# Contenido que python-docx tampoco expone como párrafo del cuerpo
+_DOCX_IGNORAR = {_W + "pPr", _W + "rPr", _W + "txbxContent", _MC + "Fallback"}
 
-        partes = []
-        # Párrafos
-        partes.extend(
-            [p.text.strip() for p in d.paragraphs if p.text and p.text.strip()]
-        )
-        # Tablas: fila por fila
-        for t in d.tables:
-            for row in t.rows:
-                celdas = []
-                for cell in row.cells:
-                    txt = " ".join(cell.text.split())
-                    if txt:
-                        celdas.append(txt)
+
+def _juntar_con_presupuesto(lineas, budget: Optional[int] = None) -> str:
+    """Une líneas con salto; deja de consumir el iterable al superar budget."""
+    partes = []
+    largo = 0
+    for linea in lineas:
+        largo += len(linea) + (1 if partes else 0)
+        partes.append(linea)
+        if budget is not None and largo > budget:
+            break
+    return "\n".join(partes).strip()
+
+
+def _docx_lineas_xml(b: Content, stats: Optional[Dict] = None):
+    """
+    Recorre word/document.xml por eventos, en orden de documento: emite cada
+    párrafo del cuerpo y cada fila de tabla ("celda | celda") a medida que se
+    cierran, sin construir el modelo de objetos de python-docx.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(paragraphs=0, table_rows=0)
+    nivel_tabla = 0
+    ignorar = 0
+    parrafo: List[str] = []
+    celda: List[str] = []
+    celdas: List[str] = []
+
+    with as_stream(b) as raw, zipfile.ZipFile(raw) as zf, zf.open("word/document.xml") as fh:
+        for evento, el in ET.iterparse(fh, events=("start", "end")):
+            tag = el.tag
+            if evento == "start":
+                if tag in _DOCX_IGNORAR:
+                    ignorar += 1
+                elif ignorar:
+                    pass
+                elif tag == _W + "tbl":
+                    nivel_tabla += 1
+                elif tag == _W + "tr" and nivel_tabla == 1:
+                    celdas = []
+                elif tag == _W + "tc" and nivel_tabla == 1:
+                    celda = []
+                elif tag == _W + "p":
+                    parrafo = []
+                continue
+
+            if tag in _DOCX_IGNORAR:
+                ignorar -= 1
+            elif ignorar:
+                pass
+            elif tag == _W + "t":
+                parrafo.append(el.text or "")
+            elif tag == _W + "tab":
+                parrafo.append("\t")
+            elif tag in (_W + "br", _W + "cr"):
+                parrafo.append("\n")
+            elif tag == _W + "p":
+                txt = "".join(parrafo)
+                if nivel_tabla:
+                    celda.append(txt)
+                elif txt.strip():
+                    stats["paragraphs"] += 1
+                    yield txt.strip()
+            elif tag == _W + "tc" and nivel_tabla == 1:
+                txt = " ".join(" ".join(celda).split())
+                if txt:
+                    celdas.append(txt)
+            elif tag == _W + "tr" and nivel_tabla == 1:
                 if celdas:
-                    partes.append(" | ".join(celdas))
+                    stats["table_rows"] += 1
+                    yield " | ".join(celdas)
+            elif tag == _W + "tbl":
+                nivel_tabla -= 1
+            el.clear()  # memoria plana: no se conserva el árbol ya recorrido
+
+
+def _docx_lineas_python_docx(b: Content):
+    """Respaldo: modelo de python-docx (párrafos primero, luego tablas)."""
+    with as_stream(b) as raw:
+        d = docx.Document(raw)
+    # Párrafos
+    for p in d.paragraphs:
+        if p.text and p.text.strip():
+            yield p.text.strip()
+    # Tablas: fila por fila
+    for t in d.tables:
+        for row in t.rows:
+            celdas = []
+            for cell in row.cells:
+                txt = " ".join(cell.text.split())
+                if txt:
+                    celdas.append(txt)
+            if celdas:
+                yield " | ".join(celdas)
+
 
-        return "\n".join(partes).strip()
+def _from_docx(b: Content, budget: Optional[int] = None, stats: Optional[Dict] = None) -> str:
+    try:
+        return _juntar_con_presupuesto(_docx_lineas_xml(b, stats), budget)
+    except Exception:
+        pass
+    if docx is None:
+        return ""
+    try:
+        return _juntar_con_presupuesto(_docx_lineas_python_docx(b), budget)
     except Exception:
         return ""
 
 
 # ---------------- TXT ----------------
-def _from_txt(b: bytes) -> str:
+def _from_txt(b: Content) -> str:
     try:
-        return b.decode("utf-8", errors="ignore").strip()
+        return str(as_buffer(b), "utf-8", errors="ignore").strip()
     except Exception:
-        return b.decode("latin-1", errors="ignore").strip()
+        return str(as_buffer(b), "latin-1", errors="ignore").strip()
 
 
 # ---------------- CSV ----------------
-def _from_csv(b: bytes) -> str:
+def _from_csv(b: Content, budget: Optional[int] = None) -> str:
     out = []
-    reader = csv.reader(io.StringIO(b.decode("utf-8", errors="ignore")))
-    for i, row in enumerate(reader):
-        out.append(", ".join(row))
-        if i >= 2000:
-            out.append("... (truncado)")
-            break
+    largo = 0
+    # Decodifica en streaming: solo se leen las filas que se usan
+    with io.TextIOWrapper(as_stream(b), encoding="utf-8", errors="ignore", newline="") as fh:
+        for i, row in enumerate(csv.reader(fh)):
+            linea = ", ".join(row)
+            largo += len(linea) + (1 if out else 0)
+            out.append(linea)
+            if i >= 2000 or (budget is not None and largo > budget):
+                out.append("... (truncado)")
+                break
     return "\n".join(out)
 
 
 # ---------------- XLSX ----------------
-def _from_xlsx(b: bytes) -> str:
+XLSX_MAX_CHARS = 300_000
+
+
+def _celda_csv(v) -> str:
+    return "" if v is None else v
+
+
+def _xlsx_stream(b: Content, budget: Optional[int] = None, stats: Optional[Dict] = None) -> str:
+    """
+    Lector en streaming: openpyxl en modo read_only entrega fila por fila y
+    cada fila se escribe como línea CSV. Se detiene en cuanto supera el
+    presupuesto (o XLSX_MAX_CHARS), así la memoria no depende del tamaño del libro.
+    """
+    stats = stats if stats is not None else {}
+    limite = XLSX_MAX_CHARS if budget is None else min(budget, XLSX_MAX_CHARS)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    hojas, filas = 0, 0
+
+    with as_stream(b) as raw:
+        wb = openpyxl.load_workbook(raw, read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                if buf.tell() > limite:
+                    break
+                buf.write(("\n" if hojas else "") + f"--- Hoja: {ws.title} ---\n")
+                hojas += 1
+                for row in ws.iter_rows(values_only=True):
+                    valores = list(row)
+                    while valores and valores[-1] is None:
+                        valores.pop()
+                    if not valores:
+                        continue
+                    writer.writerow([_celda_csv(v) for v in valores])
+                    filas += 1
+                    if buf.tell() > limite:
+                        break
+        finally:
+            wb.close()
+
+    stats.update(sheets=hojas, rows=filas)
+    txt = buf.getvalue()
+    return txt[:XLSX_MAX_CHARS] + ("... (truncado)" if len(txt) > XLSX_MAX_CHARS else "")
+
+
+def _from_xlsx(b: Content, budget: Optional[int] = None, stats: Optional[Dict] = None) -> str:
+    if openpyxl is not None:
+        try:
+            return _xlsx_stream(b, budget=budget, stats=stats)
+        except Exception:
+            pass
+    return _xlsx_pandas(b, budget=budget)
+
+
+def _xlsx_pandas(b: Content, budget: Optional[int] = None) -> str:
+    """Respaldo: pandas carga cada hoja completa y la convierte a CSV."""
     try:
-        with io.BytesIO(b) as bio:
-            sheets = pd.read_excel(bio, sheet_name=None)
         chunks = []
-        for name, df in sheets.items():
-            chunks.append(f"--- Hoja: {name} ---")
-            chunks.append(df.to_csv(index=False))
+        largo = 0
+        with as_stream(b) as bio, pd.ExcelFile(bio) as xls:
+            # Hoja por hoja: con presupuesto agotado no se leen las restantes
+            for name in xls.sheet_names:
+                df = xls.parse(name)
+                for chunk in (f"--- Hoja: {name} ---", df.to_csv(index=False)):
+                    largo += len(chunk) + (1 if chunks else 0)
+                    chunks.append(chunk)
+                if budget is not None and largo > budget:
+                    break
         txt = "\n".join(chunks)
-        return txt[:300_000] + ("... (truncado)" if len(txt) > 300_000 else "")
+        return txt[:XLSX_MAX_CHARS] + ("... (truncado)" if len(txt) > XLSX_MAX_CHARS else "")
     except Exception:
         return ""
 
 
 # ---------------- Imagen (OCR) ----------------
-def _from_image(b: bytes, lang: str = "spa+eng") -> str:
+def _alto_de_linea(gris) -> Optional[float]:
+    """
+    Alto típico de línea de texto (px) por perfil horizontal de tinta: mediana
+    de las rachas de filas con tinta. None si no se distinguen líneas.
+    """
+    try:
+        escala = min(1.0, 1200 / max(gris.size))
+        chica = gris.resize((max(1, int(gris.width * escala)), max(1, int(gris.height * escala)))) if escala < 1 else gris
+        arr = np.asarray(chica, dtype=np.int16)
+        if arr.mean() < 128:  # texto claro sobre fondo oscuro
+            arr = 255 - arr
+        tinta = arr < min(160, arr.mean() - 30)
+        filas = tinta.mean(axis=1) > 0.005
+        rachas, largo = [], 0
+        for f in filas:
+            if f:
+                largo += 1
+            elif largo:
+                rachas.append(largo)
+                largo = 0
+        rachas = [r for r in rachas if r >= 2]
+        if len(rachas) < 2:
+            return None
+        return float(np.median(rachas)) / escala
+    except Exception:
+        return None
+
+
+def _preparar_imagen(img, stats: Optional[Dict] = None):
+    """
+    Normaliza una imagen para OCR: gris, recorte de bordes uniformes y
+    re-muestreo para que las líneas de texto midan ~OCR_TARGET_LINE_PX,
+    sin superar OCR_MAX_PIXELS. stats recibe image_size, ocr_size y text_line_px.
+    """
+    stats = stats if stats is not None else {}
+    stats["image_size"] = f"{img.width}x{img.height}"
+    gris = img.convert("L")
+
+    color_fondo = gris.getpixel((0, 0))
+    fondo = Image.new("L", gris.size, color_fondo)
+    caja = ImageChops.difference(gris, fondo).point(lambda v: 255 if v > _IMG_TOLERANCIA_BORDE else 0).getbbox()
+    recortada = bool(caja) and caja != (0, 0, gris.width, gris.height)
+    if recortada:
+        gris = gris.crop(caja)
+
+    linea = _alto_de_linea(gris)
+    escala = 1.0
+    if linea:
+        stats["text_line_px"] = round(linea, 1)
+        escala = min(_IMG_ESCALA_MAX, max(_IMG_ESCALA_MIN, OCR_TARGET_LINE_PX / linea))
+    pixeles = gris.width * gris.height * escala * escala
+    if pixeles > OCR_MAX_PIXELS:
+        escala *= (OCR_MAX_PIXELS / pixeles) ** 0.5
+    if abs(escala - 1.0) > 0.05:
+        tam = (max(1, round(gris.width * escala)), max(1, round(gris.height * escala)))
+        gris = gris.resize(tam, Image.LANCZOS if escala < 1 else Image.BICUBIC)
+    if recortada:
+        gris = ImageOps.expand(gris, border=_IMG_MARGEN, fill=color_fondo)
+
+    stats["ocr_size"] = f"{gris.width}x{gris.height}"
+    return gris
+
+
+def _from_image(b: Content, lang: str = "spa+eng", stats: Optional[Dict] = None) -> str:
     if not _OCR_OK:
         return ""
     try:
-        img = Image.open(io.BytesIO(b)).convert("RGB")
-        return (pytesseract.image_to_string(img, lang=lang) or "").strip()
+        with _etapa(stats, "open"), as_stream(b) as raw:
+            img = Image.open(raw)
+            img.load()
+        with _etapa(stats, "prepare"):
+            img = _preparar_imagen(img, stats)
+        idioma, origen = lang, "override"
+        if lang == OCR_AUTO:
+            idioma, origen = OCR_LANG_DEFAULT, "default"
+            if img.width * img.height > _SONDA_MIN_PIXELS:
+                # Sonda barata: franja central con spa+eng, luego la imagen con el idioma elegido
+                with _etapa(stats, "ocr"):
+                    franja = img.crop((0, img.height // 3, img.width, 2 * img.height // 3))
+                    detectado = _detectar_idioma(_ocr_images([franja], lang=OCR_LANG_DEFAULT)[0])
+                if detectado:
+                    idioma, origen = detectado, "probe"
+        if stats is not None:
+            stats.update(ocr_lang=idioma, ocr_lang_source=origen)
+        with _etapa(stats, "ocr"):
+            return _ocr_images([img], lang=idioma)[0]
     except Exception:
         return ""
 
 
 # ================= API pública =================
-def extract_attachment(name: str, content: bytes) -> Tuple[str, Dict]:
-    """
-    Devuelve (texto_extraído, metadatos)
-    metadatos = { filename, ext, size_bytes, sha1_8, chars }
-    """
-    ext = _ext(name)
-    text = ""
-
+def _extract_text(
+    ext: str,
+    content: Content,
+    lang: str,
+    budget: Optional[int] = None,
+    stats: Optional[Dict] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+) -> str:
     if ext in SUPPORTED_DOCS:
         if ext == ".pdf":
-            text = _from_pdf(content)
+            return _from_pdf(content, lang=lang, budget=budget, stats=stats, strip_boilerplate=strip_boilerplate)
         elif ext == ".docx":
-            text = _from_docx(content)
+            return _from_docx(content, budget=budget, stats=stats)
         elif ext == ".txt":
-            text = _from_txt(content)
+            return _from_txt(content)
         elif ext == ".csv":
-            text = _from_csv(content)
+            return _from_csv(content, budget=budget)
         elif ext == ".xlsx":
-            text = _from_xlsx(content)
+            return _from_xlsx(content, budget=budget, stats=stats)
     elif ext in SUPPORTED_IMAGES:
-        text = _from_image(content)
+        return _from_image(content, lang=lang, stats=stats)
+    return ""
+
+
+def _extract_cached(
+    name: str,
+    content: Content,
+    digest: str,
+    budget: Optional[int] = None,
+    lang: Optional[str] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+) -> Tuple[str, Dict]:
+    ext = _ext(name)
+    lang = lang or OCR_LANG
+    key = _cache_key(digest, ext, lang, strip_boilerplate)
+
+    t0 = time.perf_counter()
+    hit = _EXTRACT_CACHE.get(key) if _EXTRACT_CACHE is not None else None
+    if hit is not None:
+        text = hit.get("text", "")
+        stats = dict(hit.get("stats", {}))
+        stats["timings_ms"] = {"cache": round((time.perf_counter() - t0) * 1000, 1)}
+        truncated = False
+    else:
+        stats = {}
+        text = _extract_text(ext, content, lang, budget=budget, stats=stats, strip_boilerplate=strip_boilerplate)
+        # Formatos sin etapas propias (DOCX, TXT, CSV, XLSX): todo es parseo
+        if "timings_ms" not in stats:
+            _sumar_ms(stats, "parse", (time.perf_counter() - t0) * 1000)
+        # Un extractor solo corta si supera el presupuesto: si no lo superó, el texto está completo
+        truncated = budget is not None and len(text) > budget
+        if _EXTRACT_CACHE is not None and not truncated:
+            # Los tiempos son de esta ejecución: no se guardan en la caché
+            _EXTRACT_CACHE.set(key, {"text": text, "stats": {k: v for k, v in stats.items() if k != "timings_ms"}})
+    stats["timings_ms"]["total"] = round((time.perf_counter() - t0) * 1000, 1)
+    if hit is None and stats.get("ocr_pages"):
+        stats["ocr_ms_per_page"] = round(stats["timings_ms"].get("ocr", 0.0) / stats["ocr_pages"], 1)
+    stats["peak_rss_mb"] = _peak_rss_mb()
 
     meta = {
         "filename": name,
         "ext": ext,
         "size_bytes": len(content),
         "sha1_8": _sha1_8(content),
+        "sha256": digest,
         "chars": len(text),
+        "cache_hit": hit is not None,
+        "truncated": truncated,
+        **stats,
     }
     return text, meta
 
 
+def extract_attachment(
+    name: str,
+    content: Content,
+    budget: Optional[int] = None,
+    ocr_lang: Optional[str] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+) -> Tuple[str, Dict]:
+    """
+    Devuelve (texto_extraído, metadatos)
+    metadatos = { filename, ext, size_bytes, sha1_8, sha256, chars, cache_hit, truncated }
+                + para PDF: pages, ocr_pages, ocr_pages_skipped, boilerplate_chars, boilerplate_lines,
+                  ocr_lang, ocr_lang_source (si hubo OCR)
+                + para XLSX: sheets, rows
+                + para DOCX: paragraphs, table_rows
+                + para imágenes: image_size, ocr_size, text_line_px, ocr_lang, ocr_lang_source
+                + telemetría: timings_ms (por etapa y total), ocr_ms_per_page, peak_rss_mb
+    Los resultados se guardan en la caché en disco por hash de contenido.
+    budget: máximo de caracteres útiles; PDF/DOCX/CSV/XLSX dejan de leer al superarlo
+    (el texto devuelto es un prefijo del completo, de más de budget caracteres).
+    ocr_lang: idioma(s) Tesseract forzados (p. ej. "spa"); por defecto OCR_LANG
+    ("auto": se elige por documento, ocr_lang_source dice cómo: text_layer,
+    probe, default u override).
+    strip_boilerplate: quitar encabezados/pies repetidos entre páginas del PDF
+    (por defecto STRIP_BOILERPLATE).
+    """
+    text, meta = _extract_cached(
+        name, content, _sha256(content), budget=budget, lang=ocr_lang, strip_boilerplate=strip_boilerplate
+    )
+    _registrar_telemetria(meta)
+    return text, meta
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Pool perezoso y compartido (spawn: seguro con los hilos de Streamlit)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(
+                max_workers=INGEST_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _POOL
+
+
+def _reset_pool(pool: Optional[ProcessPoolExecutor] = None) -> None:
+    """
+    Descarta el pool roto. Con `pool`, solo si sigue siendo el vigente: otro
+    hilo pudo haberlo reemplazado ya y el nuevo no se toca.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or (pool is not None and _POOL is not pool):
+            return
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+def _dedup_key(name: str, digest: str) -> Tuple[str, str]:
+    return digest, _ext(name)
+
+
+def _reuse(result: Tuple[str, Dict], name: str) -> Tuple[str, Dict]:
+    """Mismo contenido ya extraído en este lote: solo cambia el nombre."""
+    text, meta = result
+    return text, dict(meta, filename=name)
+
+
+def _extract_serial(
+    files: List[Tuple[str, Content]],
+    digests: List[str],
+    restante: Callable[[], Optional[int]],
+    progress: Optional[Callable[[int, int, str], None]] = None,
+    lang: Optional[str] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+):
+    """restante() da el presupuesto de caracteres vigente antes de cada archivo."""
+    vistos: Dict[Tuple[str, str], Tuple[str, Dict]] = {}
+    for i, ((name, content), digest) in enumerate(zip(files, digests)):
+        if progress is not None:
+            progress(i, len(files), name)
+        key = _dedup_key(name, digest)
+        if key in vistos:
+            yield _reuse(vistos[key], name)
+            continue
+        vistos[key] = _extract_cached(
+            name, content, digest, budget=restante(), lang=lang, strip_boilerplate=strip_boilerplate
+        )
+        _registrar_telemetria(vistos[key][1])
+        yield vistos[key]
+
+
+def _extract_parallel(
+    files: List[Tuple[str, Content]],
+    digests: List[str],
+    budget: Optional[int] = None,
+    progress: Optional[Callable[[int, int, str], None]] = None,
+    lang: Optional[str] = None,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+):
+    """
+    Extrae todos los adjuntos a la vez en el pool y los entrega en el orden
+    original. Los duplicados del lote se extraen una sola vez. Si el pool no
+    está disponible, cae al camino secuencial.
+    Como los archivos corren a la vez, cada uno recibe el presupuesto total.
+    """
+    primeros: Dict[Tuple[str, str], int] = {}
+    for i, ((name, _), digest) in enumerate(zip(files, digests)):
+        primeros.setdefault(_dedup_key(name, digest), i)
+
+    pool = None
+    futures: Dict[int, Any] = {}
+    try:
+        pool = _get_pool()
+        for i in primeros.values():
+            futures[i] = pool.submit(
+                _extract_cached, files[i][0], files[i][1], digests[i], budget, lang, strip_boilerplate
+            )
+    except (BrokenProcessPool, RuntimeError, OSError) as e:
+        if isinstance(e, BrokenProcessPool):
+            _reset_pool(pool)
+        for fut in futures.values():
+            fut.cancel()
+        yield from _extract_serial(files, digests, lambda: budget, progress, lang, strip_boilerplate)
+        return
+
+    resultados: Dict[int, Tuple[str, Dict]] = {}
+    try:
+        for i, ((name, content), digest) in enumerate(zip(files, digests)):
+            if progress is not None:
+                progress(i, len(files), name)
+            first = primeros[_dedup_key(name, digest)]
+            if first != i:
+                yield _reuse(resultados[first], name)
+                continue
+            try:
+                resultados[i] = futures[i].result()
+            except (BrokenProcessPool, CancelledError) as e:
+                # Pool roto, o tarea cancelada al reiniciarlo otro hilo: se rehace aquí
+                if isinstance(e, BrokenProcessPool):
+                    _reset_pool(pool)
+                resultados[i] = _extract_cached(
+                    name, content, digest, budget=budget, lang=lang, strip_boilerplate=strip_boilerplate
+                )
+            _registrar_telemetria(resultados[i][1])
+            yield resultados[i]
+    finally:
+        # Si el consumidor cortó por presupuesto, no seguimos extrayendo
+        for fut in futures.values():
+            fut.cancel()
+
+
+def _limpiar_contexto(
+    filtro: Optional[BoilerplateFilter], dedup: Optional[NearDuplicateFilter], text: str, meta: Dict
+) -> Tuple[str, Dict, Optional[int]]:
+    """
+    Limpieza entre adjuntos antes del presupuesto:
+    - boilerplate: líneas ya confirmadas y encabezado inicial ya visto
+    - casi duplicados: trozos ya incluidos desde otra fuente -> [SRC:sha1_8]
+    Devuelve (texto, meta, inicio_cola); inicio_cola marca dónde empieza el
+    último trozo de un texto truncado (incierto, ver NearDuplicateFilter.filter).
+    """
+    cola = None
+    if filtro is not None:
+        antes = filtro.chars_saved
+        # El final solo si el texto está completo: puede ser un corte por presupuesto
+        text = filtro.filter_page(filtro.filter_known(text, tail=not meta.get("truncated")), tail=False)
+        filtro.repetidas.update(meta.get("boilerplate_lines", []))
+        meta = dict(meta, boilerplate_chars=meta.get("boilerplate_chars", 0) + filtro.chars_saved - antes)
+    if dedup is not None:
+        chars, chunks = dedup.chars_saved, dedup.chunks_dropped
+        text, cola = dedup.filter(text, meta["sha1_8"], truncated=meta.get("truncated", False))
+        meta = dict(meta, dedup_chars=dedup.chars_saved - chars, dedup_chunks=dedup.chunks_dropped - chunks)
+    return text, meta, cola
+
+
 def consolidate_attachments(
-    files: List[Tuple[str, bytes]], max_chars: int = 200_000
+    files: List[Tuple[str, Content]],
+    max_chars: int = 200_000,
+    parallel: bool = False,
+    strip_boilerplate: bool = STRIP_BOILERPLATE,
+    dedup: bool = DEDUP_CHUNKS,
+    query: Optional[str] = None,
+    progress: Optional[Callable[[int, int, Optional[str]], None]] = None,
+    ocr_lang: Optional[str] = None,
 ) -> Tuple[str, List[Dict]]:
     """
     Concatena el texto de múltiples adjuntos con encabezados por fuente y
     corta a max_chars.
+    Con parallel=True la extracción corre en el pool de procesos; el orden,
+    los encabezados y el truncado son idénticos al camino secuencial.
+    Archivos repetidos en el lote (mismo contenido) se extraen una sola vez.
+    El contenido puede ser bytes o un UploadBlob (utils_uploads); los blobs en
+    disco viajan a los workers solo como ruta.
+    Cada extractor recibe el presupuesto restante y deja de leer al agotarlo.
+    Con strip_boilerplate (por defecto STRIP_BOILERPLATE) además se quitan,
+    antes de aplicar el presupuesto, las líneas de encabezado/pie repetidas
+    entre adjuntos; meta["boilerplate_chars"] informa los caracteres ahorrados.
+    Con dedup (por defecto DEDUP_CHUNKS) los párrafos casi idénticos a otros ya
+    incluidos (p. ej. otra versión del mismo documento) se reemplazan por
+    [SRC:sha1_8] de la fuente que conserva la copia; meta["dedup_chars"] y
+    meta["dedup_chunks"] informan lo ahorrado.
+    El resultado no depende de parallel ni del presupuesto que recibió cada
+    extractor: si la limpieza deja hueco en un texto truncado, se vuelve a
+    extraer completo.
+    Con query (p. ej. el texto funcional) no se corta por posición: se extraen
+    hasta PACK_EXTRACT_FACTOR x max_chars de texto candidato (en orden, con el
+    mismo corte anticipado que sin query) y de ahí se eligen los trozos más
+    relevantes (BM25) hasta max_chars, en su orden original
+    (utils_context.pack_sources); meta["chunks_selected"] / meta["chunks_total"]
+    informan la selección. El texto más allá del tope no se lee ni pasa por OCR.
+    progress(i, n, nombre) se llama antes de cada archivo y progress(n, n, None)
+    al terminar; puede lanzar IngestCancelled para abortar (utils_jobs).
+    ocr_lang fuerza el idioma OCR de todos los adjuntos (ver extract_attachment).
     """
     parts: List[str] = []
     metas: List[Dict] = []
     total = 0
+    filtro = BoilerplateFilter() if strip_boilerplate else None
+    duplicados = NearDuplicateFilter() if dedup else None
+    por_relevancia = bool(query_terms(query))
+    fuentes: List[Tuple[int, str, str]] = []    # (índice en metas, encabezado, texto)
+    # Tope de lo extraído: el contexto final, o los candidatos a elegir por relevancia
+    tope = max_chars * PACK_EXTRACT_FACTOR if por_relevancia else max_chars
+
+    digests = [_sha256(content) for _, content in files]
+    if parallel and len(files) > 1 and INGEST_MAX_WORKERS > 1:
+        results = _extract_parallel(
+            files, digests, budget=tope, progress=progress, lang=ocr_lang, strip_boilerplate=strip_boilerplate
+        )
+    else:
+        results = _extract_serial(
+            files, digests, lambda: max(0, tope - total), progress, ocr_lang, strip_boilerplate
+        )
 
-    for name, content in files:
-        text, meta = extract_attachment(name, content)
-        metas.append(meta)  # guardamos meta aunque no haya texto
+    try:
+        for (name, content), digest, (text, meta) in zip(files, digests, results):
+            if (filtro is not None or duplicados is not None) and text:
+                estados = [(f, f.snapshot()) for f in (filtro, duplicados) if f is not None]
+                text, meta, cola = _limpiar_contexto(filtro, duplicados, text, meta)
+                ventana = tope - total - len(f"\n\n### Fuente: {name} ({meta['sha1_8']})\n")
+                if meta.get("truncated") and (len(text) <= ventana or (cola is not None and cola < ventana)):
+                    # Lo quitado dejó hueco en el presupuesto (o el trozo final,
+                    # incompleto, entra en él): sin el resto del documento el
+                    # resultado dependería del presupuesto recibido
+                    for f, estado in estados:
+                        f.restore(estado)
+                    completo = _extract_cached(name, content, digest, lang=ocr_lang, strip_boilerplate=strip_boilerplate)
+                    text, meta, _ = _limpiar_contexto(filtro, duplicados, *completo)
+            metas.append(meta)  # guardamos meta aunque no haya texto
 
-        if not text:
-            continue
+            if not text:
+                continue
+            encabezado = f"### Fuente: {name} ({meta['sha1_8']})"
+            block = f"\n\n{encabezado}\n{text}"
+            if por_relevancia:
+                # Candidatos cortados en el tope: no dependen de cuánto leyó de más el extractor
+                candidato = block[: max(0, tope - total)][len(encabezado) + 3:]
+                if candidato:
+                    fuentes.append((len(metas) - 1, encabezado, candidato))
+                total += len(block)
+                if total > tope:
+                    break
+                continue
+
+            if total + len(block) > max_chars:
+                block = block[: max(0, max_chars - total)] + "\n... (truncado)"
+                parts.append(block)
+                break
 
-        block = f"\n\n### Fuente: {name} ({meta['sha1_8']})\n{text}"
-        if total + len(block) > max_chars:
-            block = block[: max(0, max_chars - total)] + "\n... (truncado)"
             parts.append(block)
-            break
+            total += len(block)
+    finally:
+        results.close()
+    if progress is not None:
+        progress(len(files), len(files), None)
 
-        parts.append(block)
-        total += len(block)
+    if por_relevancia:
+        texto, seleccion = pack_sources([(cab, txt) for _, cab, txt in fuentes], query, max_chars)
+        for (i, _, _), (elegidos, totales) in zip(fuentes, seleccion):
+            metas[i] = dict(metas[i], chunks_selected=elegidos, chunks_total=totales)
+        return texto, metas
 
     return "".join(parts).strip(), metas
 
 
+def _registrar_telemetria(meta: Dict) -> None:
+    """Suma una extracción (en el proceso principal) a los agregados del proceso."""
+    with _TELEMETRIA_LOCK:
+        t = _TELEMETRIA
+        t["files"] = t.get("files", 0) + 1
+        t["cache_hits"] = t.get("cache_hits", 0) + (1 if meta.get("cache_hit") else 0)
+        if not meta.get("cache_hit"):  # páginas efectivamente procesadas
+            for k in ("pages", "ocr_pages", "ocr_pages_skipped"):
+                t[k] = t.get(k, 0) + meta.get(k, 0)
+        t["boilerplate_chars"] = t.get("boilerplate_chars", 0) + meta.get("boilerplate_chars", 0)
+        etapas = t.setdefault("timings_ms", {})
+        for etapa, ms in meta.get("timings_ms", {}).items():
+            etapas[etapa] = round(etapas.get(etapa, 0.0) + ms, 1)
+        if meta.get("peak_rss_mb") is not None:
+            t["peak_rss_mb"] = max(t.get("peak_rss_mb") or 0.0, meta["peak_rss_mb"])
+        _LATENCIAS.append(meta.get("timings_ms", {}).get("total", 0.0))
+
+
+def ingest_telemetry() -> Dict:
+    """Agregados de ingesta del proceso: totales por etapa y percentiles de latencia por archivo."""
+    with _TELEMETRIA_LOCK:
+        t = {**_TELEMETRIA, "timings_ms": dict(_TELEMETRIA.get("timings_ms", {}))}
+        latencias = sorted(_LATENCIAS)
+    if latencias:
+        t["latency_ms"] = {
+            "p50": latencias[len(latencias) // 2],
+            "p95": latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))],
+            "max": latencias[-1],
+            "window": len(latencias),
+        }
+    if t.get("ocr_pages"):
+        t["ocr_ms_per_page"] = round(t["timings_ms"].get("ocr", 0.0) / t["ocr_pages"], 1)
+    return t
+
+
 def ocr_diagnostics() -> Dict:
     return {
         "OCR_OK": _OCR_OK,
         "tesseract_cmd": getattr(pytesseract.pytesseract, "tesseract_cmd", None) if _OCR_OK else None,
         "engine": "PyMuPDF + Tesseract",
+        "ocr_backend": OCR_BACKEND if _OCR_OK else None,
+        "ocr_batch_size": OCR_BATCH_SIZE if _OCR_OK and OCR_BACKEND == "batch" else None,
+        "extract_cache": _EXTRACT_CACHE.stats() if _EXTRACT_CACHE is not None else None,
+        "page_cache": page_cache_stats(),
+        "ingest": ingest_telemetry(),
     }
@@ -0,0 +1,160 @@
+# utils_jobs.py
+# ---------------------------------------------
+# Trabajos de ingesta en segundo plano (Procesar adjuntos)
+# - La extracción corre en un hilo de fondo (y el OCR de PDFs en el pool de
+#   procesos de utils_ingest): el script de Streamlit no queda bloqueado
+# - El id del trabajo se guarda en st.session_state y el progreso
+#   (archivo i/n, página j/m) se consulta en cada rerun
+# - Cancelable: se corta entre archivos y entre tramos de páginas
+# - Registro por proceso: el trabajo sobrevive a los reruns de la sesión
+# ---------------------------------------------
+
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from utils_ingest import IngestCancelled, consolidate_attachments, pages_progress
+
+# Trabajos simultáneos en todo el proceso (cada uno ya usa el pool de OCR)
+INGEST_JOB_WORKERS = int(os.environ.get("QA_INGEST_JOBS", "2") or 2)
+JOB_TTL_SECONDS = 3600  # trabajos terminados que nadie recogió
+
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_JOBS: Dict[str, "IngestJob"] = {}
+_LOCK = threading.Lock()
+
+
+class IngestJob:
+    """
+    Un consolidate_attachments en segundo plano.
+    status: queued | running | done | error | cancelled
+    """
+
+    def __init__(self, files: List[Tuple[str, object]], kwargs: Dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.files = files
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.files_total = len(files)
+        self.files_done = 0
+        self.current: Optional[str] = None
+        self.pages_done = 0
+        self.pages_total = 0
+        self.text = ""
+        self.metas: List[Dict] = []
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    # ---- Consulta desde la UI ----
+    def is_active(self) -> bool:
+        return not self._done.is_set()
+
+    def progress(self) -> float:
+        """Fracción 0..1: archivos completos más la parte de páginas del archivo en curso."""
+        if not self.files_total:
+            return 1.0
+        parcial = self.pages_done / self.pages_total if self.pages_total else 0.0
+        return min(1.0, (self.files_done + parcial) / self.files_total)
+
+    def describe(self) -> str:
+        if self.status == "queued":
+            return "En cola…"
+        if self.status != "running":
+            return self.status
+        texto = f"Archivo {min(self.files_done + 1, self.files_total)}/{self.files_total}"
+        if self.current:
+            texto += f": {self.current}"
+        if self.pages_total:
+            texto += f" — página {self.pages_done}/{self.pages_total}"
+        return texto
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    # ---- Ejecución (hilo de fondo) ----
+    def _check(self) -> None:
+        if self._cancel.is_set():
+            raise IngestCancelled()
+
+    def _on_file(self, i: int, n: int, name: Optional[str]) -> None:
+        self._check()
+        self.files_done, self.current = i, name
+        self.pages_done = self.pages_total = 0
+
+    def _on_pages(self, hechas: int, total: int) -> None:
+        self._check()
+        self.pages_done, self.pages_total = hechas, total
+
+    def _run(self) -> None:
+        try:
+            self._check()
+            self.status = "running"
+            with pages_progress(self._on_pages):
+                self.text, self.metas = consolidate_attachments(self.files, progress=self._on_file, **self.kwargs)
+            self.status = "done"
+        except IngestCancelled:
+            self.status = "cancelled"
+        except Exception as e:
+            self.status = "error"
+            self.error = str(e)
+        finally:
+            self.files = []  # libera las referencias a los blobs
+            self.finished = time.time()
+            self._done.set()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    with _LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=INGEST_JOB_WORKERS, thread_name_prefix="qa_ingest")
+        return _EXECUTOR
+
+
+def _limpiar_jobs(ahora: float) -> None:
+    with _LOCK:
+        for job_id in [j for j, job in _JOBS.items() if job.finished and ahora - job.finished > JOB_TTL_SECONDS]:
+            _JOBS.pop(job_id, None)
+
+
+def submit_ingest(files: List[Tuple[str, object]], **kwargs) -> str:
+    """
+    Lanza consolidate_attachments(files, **kwargs) en segundo plano y devuelve
+    el id del trabajo (para guardar en st.session_state).
+    """
+    _limpiar_jobs(time.time())
+    job = IngestJob(files, kwargs)
+    with _LOCK:
+        _JOBS[job.id] = job
+    _executor().submit(job._run)
+    return job.id
+
+
+def get_job(job_id: Optional[str]) -> Optional[IngestJob]:
+    if not job_id:
+        return None
+    with _LOCK:
+        return _JOBS.get(job_id)
+
+
+def cancel_job(job_id: Optional[str]) -> None:
+    job = get_job(job_id)
+    if job is not None:
+        job.cancel()
+
+
+def pop_job(job_id: Optional[str]) -> Optional[IngestJob]:
+    """Retira un trabajo terminado del registro (ya se copiaron sus resultados)."""
+    if not job_id:
+        return None
+    with _LOCK:
+        return _JOBS.pop(job_id, None)
@@ -0,0 +1,301 @@
+# utils_pages.py
+# ---------------------------------------------
+# Caché por página de PDFs compartida entre preview (UI) y extracción (OCR)
+# - Documentos abiertos una vez por contenido (sha256), con LRU de handles
+# - Por página: capa de texto, PNG de preview, raster gris para OCR y
+#   texto OCR por idioma, en una LRU en memoria acotada por bytes
+# - Resolución canónica: preview y OCR usan el mismo render RGB x2
+#   (144 dpi); el raster gris para OCR siempre se convierte desde él, así
+#   el texto OCR es el mismo haya o no pasado antes el preview
+# - Preview perezoso: solo la página pedida, y la siguiente se precarga en
+#   un hilo de fondo
+# - Solo en el proceso principal: los workers del pool renderizan sin caché
+# - Quien obtiene un PdfPages lo suelta con release_pages(): si ya no está en
+#   el registro (expulsado de la LRU, o sin caché) se cierra su handle
+# ---------------------------------------------
+
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import fitz  # PyMuPDF
+
+from utils_uploads import Content, UploadBlob, as_buffer, open_pdf
+
+PAGE_CACHE_MAX_MB = int(os.environ.get("QA_PAGE_CACHE_MB", "256") or 0)
+PAGE_CACHE_DOCS = 4     # documentos abiertos a la vez
+RENDER_ZOOM = 2         # zoom canónico (x2 = 144 dpi) para preview y OCR
+PREVIEW_DPI = int(72 * RENDER_ZOOM)
+
+
+class PageCache:
+    """LRU en memoria acotada por bytes (valores ya construidos: str, bytes, Pixmap)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def contains(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previo = self._items.pop(key, None)
+            if previo is not None:
+                self._bytes -= previo[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._items:
+                _, (_, tam) = self._items.popitem(last=False)
+                self._bytes -= tam
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "size_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_CACHE = PageCache(PAGE_CACHE_MAX_MB * 1024 * 1024) if PAGE_CACHE_MAX_MB > 0 else None
+_DOCS: "OrderedDict[str, PdfPages]" = OrderedDict()
+_DOCS_LOCK = threading.Lock()
+_PREFETCH: Optional[ThreadPoolExecutor] = None
+_PREFETCH_PENDIENTES = set()
+_PREFETCH_LOCK = threading.Lock()
+
+
+def _tam_texto(texto: str) -> int:
+    return len(texto) * 2 + 64
+
+
+def _tam_pixmap(pix) -> int:
+    return pix.stride * pix.height + 256
+
+
+def content_sha256(content: Content) -> str:
+    if isinstance(content, UploadBlob):
+        return content.sha256
+    return hashlib.sha256(as_buffer(content)).hexdigest()
+
+
+class PdfPages:
+    """
+    Un PDF abierto y acceso por página a través de la caché compartida.
+    Seguro entre hilos: cada acceso al documento toma `lock` (PyMuPDF no
+    admite uso concurrente del mismo documento). Si se expulsa de la LRU de
+    documentos mientras alguien lo usa, se reabre al siguiente acceso y lo
+    cierra release_pages() al terminar ese uso.
+    """
+
+    def __init__(self, content: Content, digest: Optional[str] = None, cache: Optional[PageCache] = None):
+        self.content = content
+        self.digest = digest or content_sha256(content)
+        self.cache = cache
+        self.lock = threading.RLock()
+        self.opens = 0
+        self._doc = None
+        self._page_count: Optional[int] = None
+
+    # ---- Documento ----
+    @property
+    def doc(self):
+        """Documento abierto (el llamador toma `lock` mientras lo usa)."""
+        with self.lock:
+            if self._doc is None:
+                self._doc = open_pdf(self.content)
+                self.opens += 1
+                self._page_count = self._doc.page_count
+            return self._doc
+
+    @property
+    def page_count(self) -> int:
+        with self.lock:
+            if self._page_count is None:
+                self.doc
+            return self._page_count
+
+    def close(self) -> None:
+        with self.lock:
+            if self._doc is not None:
+                self._doc.close()
+                self._doc = None
+
+    # ---- Caché ----
+    def _get(self, pno: int, tipo: tuple):
+        return self.cache.get((self.digest, pno) + tipo) if self.cache is not None else None
+
+    def _put(self, pno: int, tipo: tuple, valor, size: int) -> None:
+        if self.cache is not None:
+            self.cache.put((self.digest, pno) + tipo, valor, size)
+
+    # ---- Por página ----
+    def text(self, pno: int) -> str:
+        """Capa de texto de la página."""
+        texto = self._get(pno, ("text",))
+        if texto is None:
+            with self.lock:
+                texto = self.doc[pno].get_text("text") or ""
+            self._put(pno, ("text",), texto, _tam_texto(texto))
+        return texto
+
+    def _render(self, pno: int, zoom: float):
+        with self.lock:
+            return self.doc[pno].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+    def _guardar_gris(self, pno: int, zoom: float, pix):
+        gris = fitz.Pixmap(fitz.csGRAY, pix)
+        self._put(pno, ("gray", zoom), gris, _tam_pixmap(gris))
+        return gris
+
+    def png(self, pno: int, zoom: float = RENDER_ZOOM) -> bytes:
+        """PNG RGB de la página para preview."""
+        png = self._get(pno, ("png", zoom))
+        if png is None:
+            pix = self._render(pno, zoom)
+            png = pix.tobytes("png")
+            self._put(pno, ("png", zoom), png, len(png))
+            # Página sin capa de texto: irá a OCR; el raster gris sale de este render
+            if self.cache is not None and not self.text(pno).strip() and not self.has_gray(pno, zoom):
+                self._guardar_gris(pno, zoom, pix)
+        return png
+
+    def has_gray(self, pno: int, zoom: float = RENDER_ZOOM) -> bool:
+        return self.cache is not None and self.cache.contains((self.digest, pno, "gray", zoom))
+
+    def gray(self, pno: int, zoom: float = RENDER_ZOOM):
+        """Raster gris (Pixmap) para OCR; el Pixmap se comparte, no modificarlo."""
+        pix = self._get(pno, ("gray", zoom))
+        if pix is None:
+            pix = self._guardar_gris(pno, zoom, self._render(pno, zoom))
+        return pix
+
+    def classify(self, pno: int, clasificador: Callable) -> bool:
+        """Veredicto de clasificador(page) para la página, calculado una sola vez."""
+        veredicto = self._get(pno, ("likely_text",))
+        if veredicto is None:
+            with self.lock:
+                veredicto = bool(clasificador(self.doc[pno]))
+            self._put(pno, ("likely_text",), veredicto, 64)
+        return veredicto
+
+    def ocr_text(self, pno: int, lang: str) -> Optional[str]:
+        """Texto OCR ya obtenido para la página con ese idioma (None si no hay)."""
+        return self._get(pno, ("ocr", lang))
+
+    def set_ocr_text(self, pno: int, lang: str, texto: str) -> None:
+        self._put(pno, ("ocr", lang), texto, _tam_texto(texto))
+
+
+def pdf_pages(content: Content, digest: Optional[str] = None) -> PdfPages:
+    """
+    Páginas del PDF compartidas en el proceso (mismo objeto para el mismo
+    contenido). En un worker del pool devuelve un PdfPages sin caché. En
+    ambos casos el llamador lo suelta con release_pages() al terminar.
+    """
+    if _CACHE is None or multiprocessing.parent_process() is not None:
+        return PdfPages(content, digest)
+    digest = digest or content_sha256(content)
+    with _DOCS_LOCK:
+        paginas = _DOCS.get(digest)
+        if paginas is not None:
+            _DOCS.move_to_end(digest)
+            return paginas
+        paginas = _DOCS[digest] = PdfPages(content, digest, cache=_CACHE)
+        expulsados = []
+        while len(_DOCS) > PAGE_CACHE_DOCS:
+            expulsados.append(_DOCS.popitem(last=False)[1])
+    for viejo in expulsados:
+        viejo.close()
+    return paginas
+
+
+def _precargar(paginas: PdfPages, pno: int, zoom: float) -> None:
+    try:
+        paginas.png(pno, zoom)
+    except Exception:
+        pass  # el preview la renderiza (y muestra el error) si se llega a pedir
+    finally:
+        release_pages(paginas)
+        with _PREFETCH_LOCK:
+            _PREFETCH_PENDIENTES.discard((paginas.digest, pno, zoom))
+
+
+def prefetch_png(paginas: PdfPages, pno: int, zoom: float = RENDER_ZOOM) -> None:
+    """Renderiza en segundo plano el PNG de la página `pno` si aún no está en caché."""
+    global _PREFETCH
+    if paginas.cache is None or not 0 <= pno < paginas.page_count:
+        return
+    clave = (paginas.digest, pno, zoom)
+    if paginas.cache.contains((paginas.digest, pno, "png", zoom)):
+        return
+    with _PREFETCH_LOCK:
+        if clave in _PREFETCH_PENDIENTES:
+            return
+        _PREFETCH_PENDIENTES.add(clave)
+        if _PREFETCH is None:
+            _PREFETCH = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qa_prefetch")
+        _PREFETCH.submit(_precargar, paginas, pno, zoom)
+
+
+def is_shared(paginas: PdfPages) -> bool:
+    """True si el PdfPages vive en el registro (no hay que cerrarlo)."""
+    with _DOCS_LOCK:
+        return _DOCS.get(paginas.digest) is paginas
+
+
+def release_pages(paginas: PdfPages) -> None:
+    """
+    Fin de un uso de pdf_pages(): cierra el documento si ya no está en el
+    registro (expulsado mientras se usaba y reabierto, o sin caché). Los
+    registrados siguen abiertos para el próximo uso.
+    """
+    if not is_shared(paginas):
+        paginas.close()
+
+
+def page_cache_stats() -> Optional[Dict]:
+    if _CACHE is None:
+        return None
+    with _DOCS_LOCK:
+        docs = len(_DOCS)
+    return {**_CACHE.stats(), "open_docs": docs}
+
+
+def clear_page_cache() -> None:
+    with _DOCS_LOCK:
+        docs = list(_DOCS.values())
+        _DOCS.clear()
+    for paginas in docs:
+        paginas.close()
+    if _CACHE is not None:
+        _CACHE.clear()
@@ -3,6 +3,8 @@ from contextlib import contextmanager
 
 import streamlit as st
 from utils_ingest import consolidate_attachments
+from utils_uploads import as_buffer
+from utils_pages import PREVIEW_DPI, pdf_pages, prefetch_png, release_pages
 from utils_gemini import generar_escenarios_desde_contexto  # lo usaremos luego
 
 # Estado base
@@ -14,48 +16,83 @@ if "contexto_base" not in st.session_state: st.session_state["contexto_base"] =
 
 # --- utils_ui.py ---
 import io, re
+from collections import OrderedDict
 import streamlit as st
 
-# PDF -> imágenes por página (requiere PyMuPDF: pip install pymupdf)
-def _render_pdf_pages(file_bytes, dpi=140):
+# PDF -> imagen de UNA página, bajo demanda (requiere PyMuPDF: pip install pymupdf)
+# Las páginas quedan en la caché LRU de utils_pages (compartida con la extracción)
+def pdf_page_count(file_bytes):
     try:
-        import fitz  # PyMuPDF
-    except ImportError:
-        st.error("Falta 'pymupdf'. Instala con: pip install pymupdf")
-        return []
-    pages = []
-    with fitz.open(stream=bytes(file_bytes), filetype="pdf") as doc:
-        for page in doc:
-            pix = page.get_pixmap(dpi=dpi, alpha=False)
-            pages.append(io.BytesIO(pix.tobytes("png")))
-    return pages
-
-def _paginate_text(text, max_chars=3000):
-    # une líneas cortas, respeta párrafos y arma páginas de ~max_chars
-    if not text:
-        return [""]
-    # normaliza saltos
-    text = re.sub(r'\r\n?', '\n', text).strip()
+        paginas = pdf_pages(file_bytes)
+        try:
+            return paginas.page_count
+        finally:
+            release_pages(paginas)
+    except Exception:
+        return 0
+
+def render_pdf_page(file_bytes, pno, dpi=PREVIEW_DPI):
+    """PNG (BytesIO) de la página pno (base 0); precarga la siguiente en segundo plano."""
+    paginas = pdf_pages(file_bytes)
+    try:
+        png = paginas.png(pno, zoom=dpi / 72)
+        prefetch_png(paginas, pno + 1, zoom=dpi / 72)
+    finally:
+        release_pages(paginas)
+    return io.BytesIO(png)
+
+# Texto -> páginas: el índice (offsets) se calcula una vez por texto y se reutiliza entre reruns
+_TEXT_INDEX = OrderedDict()
+_TEXT_INDEX_MAX = 16
+
+def _indexar_texto(text, max_chars):
+    # une líneas cortas, respeta párrafos y arma páginas de ~max_chars.
+    # Cada página es un tramo [inicio, fin) de base (párrafos unidos con doble salto)
+    text = re.sub(r'\r\n?', '\n', text or "").strip()
     paras = [p.strip() for p in re.split(r'\n{2,}', text) if p.strip()]
-    pages, buf = [], ""
+    base = "\n\n".join(paras)
+    offsets, buf, pos = [], None, 0
     for p in paras:
+        ini, fin = pos, pos + len(p)
+        pos = fin + 2
         # agrega párrafo + salto doble para lectura
-        chunk = (("\n\n" if buf else "") + p)
-        if len(buf) + len(chunk) <= max_chars:
-            buf += chunk
+        c0 = ini - 2 if buf else ini
+        if (buf[1] - buf[0] if buf else 0) + (fin - c0) <= max_chars:
+            buf = (buf[0] if buf else c0, fin)
         else:
             if buf:
-                pages.append(buf)
+                offsets.append(buf)
             # si el párrafo es gigante, córtalo en trozos
-            if len(chunk) > max_chars:
-                for i in range(0, len(chunk), max_chars):
-                    pages.append(chunk[i:i+max_chars])
-                buf = ""
+            if fin - c0 > max_chars:
+                offsets.extend((k, min(k + max_chars, fin)) for k in range(c0, fin, max_chars))
+                buf = None
             else:
-                buf = chunk
+                buf = (c0, fin)
     if buf:
-        pages.append(buf)
-    return pages or [""]
+        offsets.append(buf)
+    return base, offsets
+
+def text_page_index(text, max_chars=3000):
+    """(base, offsets) de la paginación de text, memorizado por contenido."""
+    text = text or ""
+    clave = (hash(text), len(text), max_chars)
+    hit = _TEXT_INDEX.get(clave)
+    if hit is not None and (hit[0] is text or hit[0] == text):
+        _TEXT_INDEX.move_to_end(clave)
+        return hit[1], hit[2]
+    base, offsets = _indexar_texto(text, max_chars)
+    _TEXT_INDEX[clave] = (text, base, offsets)
+    while len(_TEXT_INDEX) > _TEXT_INDEX_MAX:
+        _TEXT_INDEX.popitem(last=False)
+    return base, offsets
+
+def text_page(text, page, max_chars=3000):
+    """Página page (base 1) del texto paginado y total de páginas."""
+    base, offsets = text_page_index(text, max_chars)
+    if not offsets:
+        return "", 1
+    inicio, fin = offsets[min(max(page, 1), len(offsets)) - 1]
+    return base[inicio:fin], len(offsets)
 
 def preview_document_paginado(
     file_name: str,
@@ -85,8 +122,7 @@ def preview_document_paginado(
         if not file_bytes:
             st.warning("No se recibieron bytes del PDF.")
             return
-        pages = _render_pdf_pages(file_bytes)
-        total = len(pages)
+        total = pdf_page_count(file_bytes)
         if total == 0:
             st.warning("No se pudo renderizar el PDF.")
             return
@@ -121,7 +157,7 @@ def preview_document_paginado(
 
         # Vista
         idx = st.session_state[state_key] - 1
-        st.image(pages[idx], use_column_width=True)
+        st.image(render_pdf_page(file_bytes, idx), use_column_width=True)
 
     else:
         # TEXTO
@@ -129,14 +165,13 @@ def preview_document_paginado(
             if file_bytes:
                 # intenta decodificar como utf-8
                 try:
-                    text_extraido = file_bytes.decode("utf-8", errors="ignore")
+                    text_extraido = str(as_buffer(file_bytes), "utf-8", errors="ignore")
                 except Exception:
                     text_extraido = ""
             else:
                 text_extraido = ""
 
-        pages = _paginate_text(text_extraido, max_chars=3000)
-        total = len(pages)
+        _, total = text_page(text_extraido, 1, max_chars=3000)
         if state_key not in st.session_state:
             st.session_state[state_key] = 1
 
@@ -165,9 +200,9 @@ def preview_document_paginado(
 
         # Contenedor con bordes y scroll si la página es muy larga
         with st.container(border=True):
-            st.markdown(pages[st.session_state[state_key] - 1])
+            st.markdown(text_page(text_extraido, st.session_state[state_key], max_chars=3000)[0])
 
-        st.caption("Tip: ajusta 'max_chars' en _paginate_text si quieres páginas más largas o más cortas.")
+        st.caption("Tip: ajusta 'max_chars' en text_page si quieres páginas más largas o más cortas.")
 
 
 
@@ -0,0 +1,216 @@
+# utils_uploads.py
+# ---------------------------------------------
+# Almacén de adjuntos subidos (blobs) para no leerlos varias veces en memoria
+# - Cada archivo se lee UNA vez, por trozos, calculando su hash
+# - Pequeños: quedan en memoria; grandes (> umbral): se vuelcan a disco,
+#   nombrados por hash de contenido, y se leen vía mmap / ruta
+# - Extracción (utils_ingest) y preview usan el mismo blob
+# - Los volcados viejos se borran por TTL, salvo los de blobs vivos en alguna
+#   sesión; si aun así falta el archivo, se vuelve a volcar desde el uploader
+# ---------------------------------------------
+
+import io
+import os
+import mmap
+import time
+import hashlib
+import tempfile
+import threading
+import weakref
+from typing import BinaryIO, Dict, List, Optional, Union
+
+import fitz  # PyMuPDF
+
+UPLOAD_SPOOL_THRESHOLD = int(float(os.environ.get("QA_UPLOAD_SPOOL_MB", "4") or 4) * 1024 * 1024)
+UPLOAD_DIR = os.environ.get("QA_UPLOAD_DIR") or os.path.join(tempfile.gettempdir(), "qa_uploads")
+UPLOAD_TTL_SECONDS = 6 * 3600
+_CHUNK = 1024 * 1024
+
+# Blobs en disco aún referenciados (st.session_state): la limpieza no los toca
+_VIVOS: "weakref.WeakSet" = weakref.WeakSet()
+_VIVOS_LOCK = threading.Lock()
+
+
+class UploadBlob:
+    """
+    Contenido de un adjunto. En memoria (data) o en disco (path, leído vía
+    mmap). Se puede enviar a procesos worker: en disco solo viaja la ruta.
+    """
+
+    def __init__(self, name: str, sha256: str, sha1: str, size: int,
+                 data: Optional[bytes] = None, path: Optional[str] = None):
+        self.name = name
+        self.sha256 = sha256
+        self.sha1_8 = sha1[:8]
+        self.size = size
+        self.data = data
+        self.path = path
+        self._mmap: Optional[mmap.mmap] = None
+        if path is not None:
+            with _VIVOS_LOCK:
+                _VIVOS.add(self)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getstate__(self) -> Dict:
+        estado = dict(self.__dict__)
+        estado["_mmap"] = None
+        return estado
+
+    def view(self):
+        """Vista de solo lectura sin copiar (bytes en memoria o mmap del archivo)."""
+        if self.data is not None:
+            return memoryview(self.data)
+        if self._mmap is None:
+            if self.size == 0:
+                return memoryview(b"")
+            with open(self.path, "rb") as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def available(self) -> bool:
+        """False si el archivo volcado ya no existe en disco."""
+        return self.data is not None or (self.path is not None and os.path.exists(self.path))
+
+    def touch(self) -> None:
+        """Renueva el mtime del volcado (la limpieza por TTL se cuenta desde el último uso)."""
+        if self.path is not None:
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def open(self) -> BinaryIO:
+        """Nuevo handle de lectura (el llamador lo cierra)."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # aún hay vistas vivas; se libera con el GC
+            self._mmap = None
+
+
+Content = Union[bytes, bytearray, UploadBlob]
+
+
+def _limpiar_uploads(ahora: float) -> None:
+    with _VIVOS_LOCK:
+        vivos = {blob.path for blob in list(_VIVOS)}
+    try:
+        for nombre in os.listdir(UPLOAD_DIR):
+            ruta = os.path.join(UPLOAD_DIR, nombre)
+            if ruta in vivos:
+                continue
+            if ahora - os.path.getmtime(ruta) > UPLOAD_TTL_SECONDS:
+                os.remove(ruta)
+    except OSError:
+        pass
+
+
+def spool_upload(f, name: Optional[str] = None, threshold: int = UPLOAD_SPOOL_THRESHOLD) -> UploadBlob:
+    """
+    Lee un archivo subido (UploadedFile de Streamlit o cualquier file-like)
+    una sola vez, por trozos. Hasta `threshold` bytes queda en memoria; por
+    encima se vuelca a UPLOAD_DIR/<sha256> y se libera la memoria.
+    """
+    name = name or getattr(f, "name", "adjunto")
+    if hasattr(f, "seek"):
+        f.seek(0)
+
+    h256, h1 = hashlib.sha256(), hashlib.sha1()
+    buf = bytearray()
+    tmp = None
+    size = 0
+    try:
+        while True:
+            chunk = f.read(_CHUNK)
+            if not chunk:
+                break
+            h256.update(chunk)
+            h1.update(chunk)
+            size += len(chunk)
+            if tmp is None:
+                buf += chunk
+                if len(buf) > threshold:
+                    os.makedirs(UPLOAD_DIR, exist_ok=True)
+                    tmp = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, prefix=".spool_", delete=False)
+                    tmp.write(buf)
+                    buf = bytearray()
+            else:
+                tmp.write(chunk)
+    except Exception:
+        if tmp is not None:
+            tmp.close()
+            os.remove(tmp.name)
+        raise
+
+    sha256 = h256.hexdigest()
+    if tmp is None:
+        return UploadBlob(name, sha256, h1.hexdigest(), size, data=bytes(buf))
+
+    tmp.close()
+    final = os.path.join(UPLOAD_DIR, sha256)
+    try:
+        os.replace(tmp.name, final)
+    except OSError:
+        # Ya existe y está en uso (Windows): el contenido es idéntico
+        os.remove(tmp.name)
+        try:
+            os.utime(final)
+        except OSError:
+            pass
+    _limpiar_uploads(time.time())
+    return UploadBlob(name, sha256, h1.hexdigest(), size, path=final)
+
+
+def spool_uploads(uploads: List, store: Dict[str, UploadBlob]) -> List[UploadBlob]:
+    """
+    Blobs de los archivos del uploader, reutilizando los ya volcados en
+    `store` (p. ej. st.session_state) para no releerlos en cada rerun.
+    Cada rerun renueva el mtime de los volcados en uso; si uno desapareció
+    del disco, se vuelve a volcar desde el archivo del uploader.
+    Los blobs de archivos que ya no están en el uploader se liberan.
+    """
+    blobs = []
+    vigentes = set()
+    for f in uploads or []:
+        key = str(getattr(f, "file_id", None) or f"{f.name}:{getattr(f, 'size', '')}")
+        vigentes.add(key)
+        blob = store.get(key)
+        if blob is not None and not blob.available():
+            blob.close()
+            blob = None
+        if blob is None:
+            blob = store[key] = spool_upload(f)
+        else:
+            blob.touch()
+        blobs.append(blob)
+    for key in [k for k in store if k not in vigentes]:
+        store.pop(key).close()
+    return blobs
+
+
+# ===== Acceso uniforme a bytes o blobs =====
+def as_buffer(content: Content):
+    """Buffer sin copia (bytes o memoryview) apto para hashlib, str(..., encoding) y len()."""
+    return content.view() if isinstance(content, UploadBlob) else content
+
+
+def as_stream(content: Content) -> BinaryIO:
+    """File-like de lectura; para blobs en disco lee del archivo, sin cargarlo entero."""
+    return content.open() if isinstance(content, UploadBlob) else io.BytesIO(content)
+
+
+def open_pdf(content: Content):
+    """Abre un PDF con PyMuPDF: por ruta si el blob está en disco, si no desde memoria."""
+    if isinstance(content, UploadBlob):
+        if content.path is not None:
+            return fitz.open(content.path, filetype="pdf")
+        return fitz.open(stream=content.data, filetype="pdf")
+    return fitz.open(stream=bytes(content), filetype="pdf")